@@ -0,0 +1,33 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import numpy as np
+from pathlib import Path
+from ffmpeg_utils import pcm_sample_rate
+
+
+
+class PcmAudio:
+  """Memory-mapped raw 16kHz mono PCM file, the single source of truth for VAD, duration and chunking."""
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.sample_rate = pcm_sample_rate
+    # Numpy refuses to map an empty file
+    if path.stat().st_size == 0:
+      self.samples = np.zeros(0, dtype = np.int16)
+    else:
+      self.samples = np.memmap(path, dtype = np.int16, mode = "r")
+
+
+  @property
+  def nb_samples(self):
+    return len(self.samples)
+
+
+  @property
+  def duration(self):
+    return self.nb_samples / self.sample_rate
+
+
+  def read(self, start_sample: int = 0, end_sample: int = None):
+    # Convert to the float32 [-1, 1] range expected by the models
+    return self.samples[start_sample:end_sample].astype(np.float32) / 32768.0
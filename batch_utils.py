@@ -0,0 +1,117 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import time
+import random
+from google import genai
+from google.genai import types
+import gemini_utils
+from gemini_utils import safe_json_loads
+from json_utils import TruncatedArray, IncrementalArrayParser
+
+
+
+# States after which a batch job never changes again
+finished_states = {
+  "JOB_STATE_SUCCEEDED",
+  "JOB_STATE_PARTIALLY_SUCCEEDED",
+  "JOB_STATE_FAILED",
+  "JOB_STATE_CANCELLED",
+  "JOB_STATE_EXPIRED"
+}
+
+
+
+def make_batch_request(config: types.GenerateContentConfig, content, key: str):
+  # The key comes back in the metadata of the response
+  return types.InlinedRequest(
+    contents = content,
+    config = config,
+    metadata = {'key': key}
+  )
+
+
+
+def submit_batch(client: genai.Client, requests, display_name: str):
+  print(f"Submitting batch job '{display_name}' with {len(requests)} requests...")
+  job = client.batches.create(
+    model = gemini_utils.gemini_model,
+    src = requests,
+    config = types.CreateBatchJobConfig(display_name = display_name)
+  )
+  print(f"Batch job {job.name} submitted.")
+  return job
+
+
+
+def wait_for_batch(client: genai.Client, job_name: str, poll_interval: float = 30, max_poll_interval: float = 600):
+  # Batch jobs take minutes to hours, poll less and less often while they run
+  delay = poll_interval
+  while True:
+    job = client.batches.get(name = job_name)
+    state = job.state.name if job.state is not None else "JOB_STATE_UNSPECIFIED"
+    if state in finished_states:
+      break
+    print(f"Batch job {job_name} is {state}, checking again in {delay:.0f} seconds.")
+    time.sleep(delay + random.random())
+    delay = min(delay * 2, max_poll_interval)
+
+  if state not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+    print(f"Batch job {job_name} ended with state {state}: {job.error}")
+  else:
+    print(f"Batch job {job_name} is done.")
+  return job
+
+
+
+def parse_batch_array(response: types.GenerateContentResponse, expected_key: str):
+  # Same parsing as generate_with_retry, without a second chance
+  if response is None or not response.text:
+    return None
+  clean_json = response.text.strip().replace("```json", "").replace("```", "")
+  data = safe_json_loads(clean_json)
+  if isinstance(data, dict) and isinstance(data.get(expected_key), list):
+    return data[expected_key]
+
+  # The reply was cut, keep its complete items
+  parser = IncrementalArrayParser(expected_key)
+  parser.feed(clean_json)
+  if parser.items:
+    return TruncatedArray(parser.items)
+  return None
+
+
+
+def get_batch_results(job: types.BatchJob, keys, expected_key: str):
+  # Array parsed from each response, or None when the request failed, by request key
+  results = {key: None for key in keys}
+  if job.dest is None or not job.dest.inlined_responses:
+    return results
+
+  for position, inlined_response in enumerate(job.dest.inlined_responses):
+    # The key is echoed in the metadata, otherwise responses come in the order of the requests
+    metadata = inlined_response.metadata or {}
+    key = metadata.get('key', keys[position] if position < len(keys) else None)
+    if key not in results:
+      continue
+    if inlined_response.error is not None:
+      print(f"Batch request {key} failed: {inlined_response.error}")
+      continue
+    results[key] = parse_batch_array(inlined_response.response, expected_key)
+
+  return results
+
+
+
+def run_batch(client: genai.Client, requests, expected_key: str, display_name: str, poll_interval: float = 30, on_submit = None):
+  # Requests are given as (key, InlinedRequest) pairs, on_submit gets the job name and keys to resume it later
+  keys = [key for key, _ in requests]
+  job_name = submit_batch(client, [request for _, request in requests], display_name).name
+  if on_submit is not None:
+    on_submit({'name': job_name, 'keys': keys})
+  return resume_batch(client, {'name': job_name, 'keys': keys}, expected_key, poll_interval)
+
+
+
+def resume_batch(client: genai.Client, batch, expected_key: str, poll_interval: float = 30):
+  # Wait for a job submitted earlier, possibly by a previous run
+  job = wait_for_batch(client, batch['name'], poll_interval)
+  return get_batch_results(job, batch['keys'], expected_key)
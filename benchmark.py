@@ -0,0 +1,496 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import os
+import gc
+import sys
+import json
+import time
+import signal
+import random
+import subprocess
+import statistics
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from pathlib import Path
+from ffmpeg_utils import extract_all_audio, extract_chunks, pcm_input_args, pcm_sample_rate
+from gemini_utils import gemini_model, get_client
+from audio_utils import PcmAudio
+from vad_utils import find_optimal_split_points, find_speech_gaps, get_chunk_speech_budget, SpeechDensity
+from subtitle_utils import SubtitleTrack
+from fake_gemini_utils import FakeGeminiServer
+from metrics_utils import metrics, read_peak_rss
+from processing_utils import run
+from main import create_parser, parse_args
+
+
+
+def benchmark_upload(args):
+  client = get_client(os.environ.get("GEMINI_API_KEY"))
+
+  with tempfile.TemporaryDirectory() as tmp_dir_name:
+    working_dir = Path(tmp_dir_name)
+
+    # Cut the input at regular intervals
+    audio_path = extract_all_audio(Path(args.input), working_dir)
+    duration = PcmAudio(audio_path).duration
+    splits = [t for t in range(args.chunk_duration, int(duration), args.chunk_duration)]
+
+    results = []
+    for upload_format in args.formats.split(","):
+      print(f"Benchmarking {upload_format}...")
+
+      # Encoding
+      encode_start = time.perf_counter()
+      chunks = extract_chunks(audio_path, splits, working_dir, upload_format, args.bitrate)
+      encode_time = time.perf_counter() - encode_start
+
+      total_bytes = 0
+      upload_time = 0
+      processing_time = 0
+      tokens = 0
+      for chunk in chunks:
+        total_bytes += chunk['audio'].stat().st_size
+
+        # Upload
+        upload_start = time.perf_counter()
+        uploaded_file = client.files.upload(file = str(chunk['audio'].resolve()))
+        upload_time += time.perf_counter() - upload_start
+
+        # Wait for the server to process the file
+        processing_start = time.perf_counter()
+        while uploaded_file.state.name == "PROCESSING":
+          time.sleep(0.5)
+          uploaded_file = client.files.get(name = uploaded_file.name)
+        processing_time += time.perf_counter() - processing_start
+
+        # Input tokens the transcription request would be billed for
+        try:
+          tokens += client.models.count_tokens(model = gemini_model, contents = [uploaded_file]).total_tokens
+        finally:
+          client.files.delete(name = uploaded_file.name)
+
+      results.append((upload_format, len(chunks), total_bytes, encode_time, upload_time, processing_time, tokens))
+
+  # Report
+  print(f"{'Format':8} | {'Chunks':>6} | {'Bytes':>12} | {'Encode (s)':>10} | {'Upload (s)':>10} | {'Processing (s)':>14} | {'Tokens':>8}")
+  for upload_format, nb_chunks, total_bytes, encode_time, upload_time, processing_time, tokens in results:
+    print(f"{upload_format:8} | {nb_chunks:6} | {total_bytes:12} | {encode_time:10.2f} | {upload_time:10.2f} | {processing_time:14.2f} | {tokens:8}")
+
+
+
+def generate_speech_timestamps(nb_segments: int, seed: int = 0):
+  # Dense dialogue, short lines separated by short pauses
+  rng = random.Random(seed)
+  speech_timestamps = []
+  t = 0.0
+  for _ in range(nb_segments):
+    start = t + rng.expovariate(1 / 0.8)
+    end = start + rng.uniform(0.3, 6.0)
+    speech_timestamps.append({
+      'start': round(start, 1),
+      'end'  : round(end, 1)
+    })
+    t = end
+  return speech_timestamps, t + 1.0
+
+
+
+def benchmark_splits(args):
+  speech_timestamps, duration = generate_speech_timestamps(args.segments)
+  gap_durations = {round(g['midpoint'], 6): g['duration'] for g in find_speech_gaps(speech_timestamps)}
+  print(f"{args.segments} segments, {duration:.0f} seconds")
+
+  # Chunks also limited by the speech they hold when a token budget is given
+  density = SpeechDensity(speech_timestamps)
+  speech_budget = get_chunk_speech_budget(density.total, args.chunk_tokens) if args.chunk_tokens > 0 else None
+
+  print(f"{'Mode':8} | {'Time (s)':>8} | {'Chunks':>6} | {'Min (s)':>7} | {'Max (s)':>7} | {'Stdev (s)':>9} | {'Gaps (s)':>8} | {'Speech (s)':>10}")
+  for mode in ("greedy", "balanced"):
+    start_time = time.perf_counter()
+    splits = find_optimal_split_points(speech_timestamps, duration, args.max_duration, mode, speech_budget)
+    elapsed = time.perf_counter() - start_time
+
+    # Chunk lengths, total silence at the split points and most speech in a chunk
+    points = [0] + splits + [duration]
+    lengths = [b - a for a, b in zip(points, points[1:])]
+    gaps = sum(gap_durations.get(round(split, 6), 0) for split in splits)
+    speech = max(density.before(points[1:]) - density.before(points[:-1]))
+    print(f"{mode:8} | {elapsed:8.3f} | {len(lengths):6} | {min(lengths):7.1f} | {max(lengths):7.1f} | {statistics.pstdev(lengths):9.2f} | {gaps:8.1f} | {speech:10.1f}")
+
+
+
+def generate_chunk_subtitles(nb_cues: int, nb_chunks: int, seed: int = 0):
+  # Lists of subtitle dicts as Gemini returns them, one list per chunk
+  rng = random.Random(seed)
+  chunks = []
+  start = 0.0
+  for c in range(nb_chunks):
+    subtitles = []
+    t = 0.0
+    for i in range(nb_cues // nb_chunks):
+      t += rng.uniform(0.2, 2.0)
+      subtitles.append({'index': i + 1, 'start': t, 'end': t + rng.uniform(0.5, 4.0), 'text': f"Line {i} of chunk {c}"})
+    chunks.append({'start': start, 'data': subtitles})
+    start += 120.0
+  return chunks
+
+
+
+def merge_subtitle_dicts(chunks):
+  # How subtitles were merged before SubtitleTrack, one dict at a time
+  subtitles = []
+  i = 0
+  for chunk in chunks:
+    for sub in chunk['data']:
+      sub['index'] = sub['index'] + i
+      sub['start'] = sub['start'] + chunk['start']
+      sub['end'] = sub['end'] + chunk['start']
+    subtitles.extend(chunk['data'])
+    i += len(chunk['data'])
+  return subtitles
+
+
+
+def benchmark_tracks(args):
+  print(f"{args.cues} cues in {args.chunks} chunks")
+  print(f"{'Layout':12} | {'Build (s)':>9} | {'Merge (s)':>9} | {'Shift (s)':>9} | {'Slice (s)':>9} | {'Peak (MB)':>9}")
+
+  for layout in ("dicts", "track"):
+    chunks = generate_chunk_subtitles(args.cues, args.chunks)
+    gc.collect()
+    tracemalloc.start()
+
+    # Build what the merge takes as input
+    start_time = time.perf_counter()
+    if layout == "track":
+      chunks = [{'start': chunk['start'], 'data': SubtitleTrack.from_subtitles(chunk['data'])} for chunk in chunks]
+    build_time = time.perf_counter() - start_time
+
+    # Merge every chunk into one track
+    start_time = time.perf_counter()
+    if layout == "track":
+      merged = SubtitleTrack.concatenate([chunk['data'] for chunk in chunks], [chunk['start'] for chunk in chunks])
+    else:
+      merged = merge_subtitle_dicts(chunks)
+    merge_time = time.perf_counter() - start_time
+
+    # Shift the whole track, e.g. to resync it
+    start_time = time.perf_counter()
+    if layout == "track":
+      merged.shifted(1.5)
+    else:
+      [dict(sub, start = sub['start'] + 1.5, end = sub['end'] + 1.5) for sub in merged]
+    shift_time = time.perf_counter() - start_time
+
+    # Cues of every chunk
+    start_time = time.perf_counter()
+    for chunk in chunks:
+      if layout == "track":
+        merged.between(chunk['start'], chunk['start'] + 120.0)
+      else:
+        [sub for sub in merged if chunk['start'] <= sub['start'] < chunk['start'] + 120.0]
+    slice_time = time.perf_counter() - start_time
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{layout:12} | {build_time:9.3f} | {merge_time:9.3f} | {shift_time:9.3f} | {slice_time:9.3f} | {peak / 1024 / 1024:9.1f}")
+    del chunks, merged
+
+
+
+# Formants of a few vowels, in Hz
+synthetic_vowels = [(730, 1090, 2440), (270, 2290, 3010), (300, 870, 2240), (530, 1840, 2480), (570, 840, 2410), (440, 1020, 2240), (660, 1720, 2410)]
+
+
+
+def generate_synthetic_speech(duration: float, rng: np.random.Generator):
+  # Syllables of a formant synthesizer, close enough to a voice for silero to take it as speech
+  # A plain tone is rejected after a few seconds
+  sample_rate = pcm_sample_rate
+  syllables = []
+  nb_samples = int(duration * sample_rate)
+  while sum(len(syllable) for syllable in syllables) < nb_samples:
+    length = int(rng.uniform(0.12, 0.28) * sample_rate)
+    # Glottal pulses with some jitter, a pitch around 120 Hz
+    pitch = rng.uniform(100, 150)
+    phase = np.cumsum(np.full(length, pitch / sample_rate) * (1 + 0.01 * rng.standard_normal(length)))
+    source = np.diff(np.floor(phase), prepend = 0) + 0.02 * rng.standard_normal(length)
+    # Through the resonances of a random vowel
+    t = np.arange(int(0.03 * sample_rate)) / sample_rate
+    syllable = np.zeros(length)
+    for rank, (formant, gain) in enumerate(zip(synthetic_vowels[rng.integers(len(synthetic_vowels))], (1.0, 0.5, 0.25))):
+      response = np.exp(-np.pi * (80 + 40 * rank) * t) * np.sin(2 * np.pi * formant * t)
+      syllable += gain * np.convolve(source, response)[:length]
+    syllable *= np.sin(np.linspace(0, np.pi, length)) ** 0.5
+    # Half of them start with a consonant
+    if rng.random() < 0.5:
+      consonant = int(0.05 * sample_rate)
+      syllable[:consonant] += 0.3 * np.std(syllable) * rng.standard_normal(consonant)
+    syllables.append(syllable)
+  speech = np.concatenate(syllables)[:nb_samples]
+  return speech / np.max(np.abs(speech)) * 0.5
+
+
+
+def generate_synthetic_video(output_path: Path, duration: float, density: float, period: float = 6.0, seed: int = 0):
+  # Speaking for the given share of every period, silent for the rest
+  rng = np.random.default_rng(seed)
+  audio_path = output_path.with_suffix(".pcm")
+  with open(audio_path, "wb") as audio_file:
+    for start in np.arange(0, duration, period):
+      samples = np.zeros(int(min(period, duration - start) * pcm_sample_rate))
+      speech_duration = min(density * period, len(samples) / pcm_sample_rate)
+      if speech_duration > 0:
+        speech = generate_synthetic_speech(speech_duration, rng)
+        samples[:len(speech)] = speech
+      audio_file.write((samples * 32767).astype(np.int16).tobytes())
+
+  command = [
+    "ffmpeg", "-hide_banner", "-loglevel", "level+error",
+    *pcm_input_args, "-i", audio_path,
+    "-f", "lavfi", "-i", f"color=c=black:s=160x120:r=1:d={duration}",
+    "-c:v", "libx264", "-preset", "ultrafast",
+    "-c:a", "aac",
+    "-shortest",
+    "-y", output_path
+  ]
+  subprocess.run(command, capture_output = True, check = True)
+  audio_path.unlink()
+  return output_path
+
+
+
+def benchmark_pipeline(args):
+  # The real run, staged pipeline and worker processes included, against the fake server
+  with tempfile.TemporaryDirectory() as tmp_dir_name, FakeGeminiServer(args.latency, args.rate_limit_rate, args.truncation_rate, args.processing_time, args.cues) as server:
+    working_dir = Path(tmp_dir_name)
+
+    # Synthetic input of the requested length and speech density
+    print(f"Generating {args.duration:.0f} seconds of synthetic video, {args.density:.0%} speech...")
+    video_path = generate_synthetic_video(working_dir / "synthetic.mp4", args.duration, args.density)
+
+    # Same command line as a user would give, without spending quota
+    os.environ.setdefault("GEMINI_API_KEY", "fake")
+    argv = [
+      str(video_path),
+      "--base-url", server.base_url,
+      "--job-dir", str(working_dir / "jobs"),
+      "--no-cache",
+      "--keep-job",
+      "--rpm", "1000000",
+      "--tpm", "1000000000",
+      "--workers", str(args.workers),
+      "--max-duration", str(args.max_duration),
+      "--chunk-tokens", str(args.chunk_tokens),
+      "--chunk-concurrency", str(args.chunk_concurrency),
+      "--split-mode", args.split_mode,
+      "--segmenter", args.segmenter,
+      "--upload-format", args.upload_format,
+      "--inline-size", str(args.inline_size),
+      "--targets", args.targets
+    ]
+    if args.stream:
+      argv.append("--stream")
+    if args.elide_silence:
+      argv.append("--elide-silence")
+    start_time = time.perf_counter()
+    run(parse_args(create_parser(), argv))
+    total_time = time.perf_counter() - start_time
+    report = metrics.report()
+    stats = dict(server.stats)
+    subtitle_path = video_path.with_name(f"{video_path.stem}.jp.srt")
+    nb_cues = count_cues(subtitle_path)[0] if subtitle_path.exists() else 0
+    # What the real VAD found in the synthetic speech, and the chunks cut from it
+    manifest = json.loads(next((working_dir / "jobs").glob("*/manifest.json")).read_text())['stages']
+    speech = sum(segment['end'] - segment['start'] for segment in manifest['speech_timestamps'])
+    nb_chunks = len(manifest['splits'])
+
+  # Stages side by side: busy time is the sum of their spans, wall time from the first start to the last end
+  stages = {}
+  for span in report['spans']:
+    stage = stages.setdefault(span['name'], {'count': 0, 'busy': 0.0, 'first': span['start'], 'last': 0.0})
+    stage['count'] += 1
+    stage['busy'] += span['duration']
+    stage['first'] = min(stage['first'], span['start'])
+    stage['last'] = max(stage['last'], span['start'] + span['duration'])
+
+  # Report
+  print(f"{args.duration:.0f} seconds of audio, {nb_cues} subtitles in {total_time:.1f} seconds, {args.duration / total_time:.0f} audio seconds per second")
+  print(f"VAD: {speech:.0f} seconds of speech found for {args.duration * args.density:.0f} generated, {nb_chunks} chunks")
+  print(f"Server: {stats['generate']} requests, {stats['upload']} uploads, {stats['rate_limited']} rate limited, {stats['truncated']} truncated")
+  print(f"{'Stage':10} | {'Spans':>5} | {'Busy (s)':>8} | {'Wall (s)':>8} | {'Audio s/s':>10}")
+  for name, stage in stages.items():
+    wall = stage['last'] - stage['first']
+    throughput = args.duration / wall if wall > 0 else float("inf")
+    print(f"{name:10} | {stage['count']:5} | {stage['busy']:8.2f} | {wall:8.2f} | {throughput:10.0f}")
+
+  # Every ffmpeg process is measured on its own by wait4
+  summaries = {(summary['name'], summary['labels'].get('operation')): summary for summary in report['summaries']}
+  print(f"{'FFmpeg':14} | {'Runs':>5} | {'Wall (s)':>8} | {'CPU (s)':>8} | {'Peak RSS (MB)':>13}")
+  for (name, operation), wall in summaries.items():
+    if name != "ffmpeg_wall_seconds":
+      continue
+    cpu = summaries[("ffmpeg_cpu_seconds", operation)]
+    rss = summaries.get(("ffmpeg_max_rss_bytes", operation))
+    peak_rss = f"{rss['max'] / 1024 / 1024:13.1f}" if rss is not None else f"{'-':>13}"
+    print(f"{operation:14} | {wall['count']:5} | {wall['sum']:8.2f} | {cpu['sum']:8.2f} | {peak_rss}")
+  prepare_rss = summaries.get(("prepare_max_rss_bytes", None))
+  print(f"Peak RSS: {(read_peak_rss() or 0) / 1024 / 1024:.1f} MB for the pipeline process, {prepare_rss['max'] / 1024 / 1024 if prepare_rss else 0:.1f} MB for the preparation workers")
+
+
+
+def start_job(video_path: Path, base_url: str, log_path: Path, *arguments):
+  # A real command line in its own process group, so that it can be interrupted like a crashed run
+  command = [sys.executable, str(Path(__file__).with_name("main.py")), str(video_path), "--batch", "--base-url", base_url, "--no-cache", "--rpm", "1000000", "--tpm", "1000000000", *arguments]
+  with open(log_path, "w") as log:
+    return subprocess.Popen(command, stdout = log, stderr = subprocess.STDOUT, env = dict(os.environ, GEMINI_API_KEY = "fake"), start_new_session = True)
+
+
+
+def count_cues(subtitle_path: Path):
+  blocks = [block.splitlines() for block in subtitle_path.read_text(encoding = "utf-8").strip().split("\n\n") if block.strip()]
+  return len(blocks), [block[2] for block in blocks if len(block) > 2]
+
+
+
+def check_batch(args):
+  # Batch mode against the batch endpoints of the fake server: failed and cut requests, then a job resumed after a crash
+  problems = []
+  with tempfile.TemporaryDirectory() as tmp_dir_name, FakeGeminiServer(args.latency, 0.0, args.truncation_rate, args.processing_time, args.cues, seed = args.seed, batch_time = args.batch_time, batch_failure_rate = args.failure_rate) as server:
+    working_dir = Path(tmp_dir_name)
+    print(f"Generating {args.duration:.0f} seconds of synthetic video...")
+    video_path = generate_synthetic_video(working_dir / "synthetic.mp4", args.duration, 0.6)
+    job_arguments = ["--job-dir", str(working_dir / "jobs"), "--keep-job", "--max-duration", str(args.max_duration), "--chunk-tokens", "0", "--upload-format", args.upload_format, "--batch-poll-interval", "0.5"]
+    manifest_path = working_dir / "jobs" / ".synthetic.geminisub" / "manifest.json"
+
+    # First run, stopped as soon as its transcription job is submitted
+    start_time = time.perf_counter()
+    process = start_job(video_path, server.base_url, working_dir / "first.log", *job_arguments)
+    submitted = False
+    while process.poll() is None and time.perf_counter() - start_time < args.timeout:
+      if manifest_path.exists() and 'transcription_batch' in json.loads(manifest_path.read_text(encoding = "utf-8"))['stages']:
+        submitted = True
+        break
+      time.sleep(0.1)
+    if process.poll() is None:
+      os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+    if not submitted:
+      problems.append("the first run never submitted its transcription job")
+    print(f"First run stopped after {time.perf_counter() - start_time:.1f} seconds, {server.stats['batch']} batch job submitted.")
+
+    # Second run, waiting for the same job instead of submitting it again
+    start_time = time.perf_counter()
+    process = start_job(video_path, server.base_url, working_dir / "second.log", "--resume", *job_arguments)
+    try:
+      process.wait(timeout = args.timeout)
+    except subprocess.TimeoutExpired:
+      os.killpg(process.pid, signal.SIGKILL)
+      process.wait()
+      problems.append("the resumed run did not finish in time")
+    log = (working_dir / "second.log").read_text(errors = "replace")
+    print(f"Resumed run done in {time.perf_counter() - start_time:.1f} seconds.")
+    stats = dict(server.stats)
+
+    if "Resuming batch job" not in log:
+      problems.append("the resumed run did not wait for the job of the first run")
+    if stats['batch'] != 2:
+      problems.append(f"{stats['batch']} batch jobs were submitted instead of one for the transcriptions and one for the translations")
+
+    # Every chunk has all its subtitles, whether from the batch or sent again directly
+    nb_chunks = len(json.loads(manifest_path.read_text(encoding = "utf-8"))['chunks']) if manifest_path.exists() else 0
+    for suffix in ("jp", "en"):
+      subtitle_path = video_path.with_name(f"{video_path.stem}.{suffix}.srt")
+      if not subtitle_path.exists():
+        problems.append(f"{subtitle_path.name} was not written")
+        continue
+      nb_cues, texts = count_cues(subtitle_path)
+      if nb_cues != nb_chunks * args.cues:
+        problems.append(f"{subtitle_path.name} has {nb_cues} subtitles instead of {nb_chunks * args.cues}")
+      if suffix == "en" and not all(text.startswith("Translated") for text in texts):
+        problems.append(f"{subtitle_path.name} has untranslated lines")
+
+  # Report
+  print(f"{nb_chunks} chunks, server: {stats['batch']} batch jobs of {stats['batch_requests']} requests, {stats['batch_failed']} failed, {stats['truncated']} truncated, {stats['generate']} sent again directly")
+  if problems:
+    print("Batch mode check failed:")
+    for problem in problems:
+      print(f"- {problem}")
+    print(log[-3000:])
+    sys.exit(1)
+  print("Batch mode check passed.")
+
+
+
+def main():
+  # Setup the argument parser
+  parser = argparse.ArgumentParser(description = "Measure the performance of GeminiSub.")
+  subparsers = parser.add_subparsers(dest = "command", required = True)
+
+  # Upload formats
+  upload_parser = subparsers.add_parser("upload", help = "Compare upload bytes, processing wait and tokens of each upload format")
+  upload_parser.add_argument("input", type = str, help = "Path to the source video file")
+  upload_parser.add_argument("--formats", type = str, default = "mp4,mp3,opus,flac", help = "Comma separated upload formats to compare")
+  upload_parser.add_argument("--bitrate", type = str, help = "Audio bitrate of the uploaded chunks, e.g. 24k")
+  upload_parser.add_argument("--chunk-duration", type = int, default = 120, help = "Duration of each chunk in seconds")
+  upload_parser.set_defaults(function = benchmark_upload)
+
+  # Split point search
+  splits_parser = subparsers.add_parser("splits", help = "Time the split point search on synthetic speech timestamps")
+  splits_parser.add_argument("--segments", type = int, default = 100000, help = "Number of synthetic speech segments")
+  splits_parser.add_argument("--max-duration", type = float, default = 120, help = "Maximum duration of a chunk in seconds")
+  splits_parser.add_argument("--chunk-tokens", type = int, default = 0, help = "Expected transcription tokens of a chunk, 0 to only cut by duration")
+  splits_parser.set_defaults(function = benchmark_splits)
+
+  # Subtitle track layouts
+  tracks_parser = subparsers.add_parser("tracks", help = "Compare lists of subtitle dicts with SubtitleTrack arrays")
+  tracks_parser.add_argument("--cues", type = int, default = 100000, help = "Number of synthetic subtitles")
+  tracks_parser.add_argument("--chunks", type = int, default = 500, help = "Number of chunks the subtitles are spread over")
+  tracks_parser.set_defaults(function = benchmark_tracks)
+
+  # Whole pipeline against a local fake of the API
+  pipeline_parser = subparsers.add_parser("pipeline", help = "Time every stage on synthetic media against a local fake of the Gemini API")
+  pipeline_parser.add_argument("--duration", type = float, default = 600, help = "Duration of the synthetic video in seconds")
+  pipeline_parser.add_argument("--density", type = float, default = 0.6, help = "Share of the time with speech, between 0 and 1")
+  pipeline_parser.add_argument("--max-duration", type = float, default = 600, help = "Maximum duration of a chunk in seconds")
+  pipeline_parser.add_argument("--chunk-tokens", type = int, default = 1500, help = "Expected transcription tokens of a chunk, 0 to only cut by duration")
+  pipeline_parser.add_argument("--chunk-concurrency", type = int, default = 4, help = "Minimum number of chunks when there is enough speech")
+  pipeline_parser.add_argument("--split-mode", type = str, choices = ["greedy", "balanced"], default = "greedy", help = "How split points are chosen")
+  pipeline_parser.add_argument("--segmenter", type = str, choices = ["single", "per-chunk"], default = "single", help = "Cut all chunks in one ffmpeg pass, or one ffmpeg process per chunk")
+  pipeline_parser.add_argument("--elide-silence", action = "store_true", help = "Only upload the speech found by VAD")
+  pipeline_parser.add_argument("--targets", type = str, default = "en", help = "Comma separated codes of the languages to translate to")
+  pipeline_parser.add_argument("--upload-format", type = str, default = "mp4", help = "Format of the uploaded chunks")
+  pipeline_parser.add_argument("--inline-size", type = float, default = 4, help = "Chunks up to this size in MB are sent inline")
+  pipeline_parser.add_argument("--workers", type = int, default = 4, help = "Number of chunks processed at the same time")
+  pipeline_parser.add_argument("--stream", action = "store_true", help = "Stream the replies")
+  pipeline_parser.add_argument("--latency", type = float, default = 0.5, help = "Average latency of the fake server in seconds")
+  pipeline_parser.add_argument("--rate-limit-rate", type = float, default = 0.0, help = "Share of the requests refused with a 429")
+  pipeline_parser.add_argument("--truncation-rate", type = float, default = 0.0, help = "Share of the replies cut short")
+  pipeline_parser.add_argument("--processing-time", type = float, default = 1.0, help = "Seconds the fake server takes to process an uploaded file")
+  pipeline_parser.add_argument("--cues", type = int, default = 40, help = "Subtitles in each fake transcription")
+  pipeline_parser.set_defaults(function = benchmark_pipeline)
+
+  # Batch mode against a local fake of the batch endpoints
+  batch_parser = subparsers.add_parser("batch", help = "Check --batch against a local fake of the batch endpoints, with failed and cut requests and a resumed job")
+  batch_parser.add_argument("--duration", type = float, default = 300, help = "Duration of the synthetic video in seconds")
+  batch_parser.add_argument("--max-duration", type = float, default = 60, help = "Maximum duration of a chunk in seconds")
+  batch_parser.add_argument("--upload-format", type = str, default = "opus", help = "Format of the uploaded chunks, opus is the quickest to encode")
+  batch_parser.add_argument("--failure-rate", type = float, default = 0.3, help = "Share of the batch requests that fail")
+  batch_parser.add_argument("--truncation-rate", type = float, default = 0.3, help = "Share of the replies cut short")
+  batch_parser.add_argument("--batch-time", type = float, default = 5.0, help = "Seconds the fake server takes to run a batch job")
+  batch_parser.add_argument("--latency", type = float, default = 0.1, help = "Average latency of the fake server in seconds")
+  batch_parser.add_argument("--processing-time", type = float, default = 0.2, help = "Seconds the fake server takes to process an uploaded file")
+  batch_parser.add_argument("--cues", type = int, default = 10, help = "Subtitles in each fake transcription")
+  batch_parser.add_argument("--seed", type = int, default = 1, help = "Seed of the failures and cuts of the fake server")
+  batch_parser.add_argument("--timeout", type = float, default = 300, help = "Seconds each run may take")
+  batch_parser.set_defaults(function = check_batch)
+
+  # Parse args
+  args = parser.parse_args()
+  args.function(args)
+
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,97 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+
+
+def get_default_cache_path():
+  cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+  return Path(cache_home) / "geminisub" / "results.sqlite3"
+
+
+
+def hash_file(file_path: Path):
+  # Hash the file in blocks so that large chunks are never loaded whole
+  digest = hashlib.sha256()
+  with open(file_path, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+
+def make_cache_key(*parts):
+  # Every part is length prefixed so that the parts cannot bleed into each other
+  digest = hashlib.sha256()
+  for part in parts:
+    if not isinstance(part, bytes):
+      part = str(part).encode("utf-8")
+    digest.update(len(part).to_bytes(8, "little"))
+    digest.update(part)
+  return digest.hexdigest()
+
+
+
+class ResultCache:
+  """SQLite store of parsed Gemini results, evicting the least recently used entries above a size limit."""
+
+  def __init__(self, path: Path, max_bytes: int = 512 * 1024 * 1024):
+    path.parent.mkdir(parents = True, exist_ok = True)
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(str(path), check_same_thread = False)
+    self.connection.execute("""
+      CREATE TABLE IF NOT EXISTS results (
+        key         TEXT PRIMARY KEY,
+        value       TEXT NOT NULL,
+        size        INTEGER NOT NULL,
+        last_access REAL NOT NULL
+      )
+    """)
+    self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+    self.connection.commit()
+
+
+  def get(self, key: str):
+    with self.lock:
+      row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        return None
+      self.connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+      self.connection.commit()
+    return json.loads(row[0])
+
+
+  def put(self, key: str, value):
+    data = json.dumps(value, ensure_ascii = False)
+    with self.lock:
+      self.connection.execute(
+        "INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+        (key, data, len(data.encode("utf-8")), time.time())
+      )
+      self._evict()
+      self.connection.commit()
+
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+
+  def _evict(self):
+    # Drop the oldest entries until the cache fits again
+    total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+    if total_size <= self.max_bytes:
+      return
+    evicted = []
+    for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY last_access ASC"):
+      if total_size <= self.max_bytes:
+        break
+      evicted.append((key,))
+      total_size -= size
+    self.connection.executemany("DELETE FROM results WHERE key = ?", evicted)
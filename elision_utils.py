@@ -0,0 +1,90 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import numpy as np
+from pathlib import Path
+from audio_utils import PcmAudio
+
+
+
+class OffsetMap:
+  """Where each stretch of speech kept in the uploaded audio comes from, to put the times given by the model back on the chunk timeline."""
+
+  def __init__(self, segments):
+    # Segments are [uploaded start, chunk start, duration] triples, in order
+    segments = np.asarray(segments, dtype = np.float64).reshape(-1, 3)
+    self.uploaded_starts = segments[:, 0]
+    self.chunk_starts = segments[:, 1]
+    self.durations = segments[:, 2]
+
+
+  @classmethod
+  def from_regions(cls, regions, chunk_start: float):
+    # Regions are the (start, end) source times that were kept, one after the other
+    segments = []
+    uploaded_start = 0.0
+    for start, end in regions:
+      segments.append([uploaded_start, start - chunk_start, end - start])
+      uploaded_start += end - start
+    return cls(segments)
+
+
+  @property
+  def duration(self):
+    # Duration of the uploaded audio
+    return float(self.durations.sum())
+
+
+  def to_chunk_time(self, t, end: bool = False):
+    """Time in the uploaded audio to time in the chunk, t can be an array."""
+    t = np.asarray(t, dtype = np.float64)
+    if len(self.durations) == 0:
+      return t
+    # A start on the boundary of two segments begins the next one, an end there closes the previous one
+    # Otherwise a cue ending on the boundary would stretch over the whole silence that was cut
+    segment = np.maximum(np.searchsorted(self.uploaded_starts, t, side = "left" if end else "right") - 1, 0)
+    # Past the end of the last segment the model overshot, keep the same pace
+    within = t - self.uploaded_starts[segment]
+    last = segment == len(self.durations) - 1
+    within = np.where(last, within, np.minimum(within, self.durations[segment]))
+    return self.chunk_starts[segment] + np.maximum(within, 0)
+
+
+  def to_list(self):
+    # For the manifest
+    return np.stack([self.uploaded_starts, self.chunk_starts, self.durations], axis = 1).tolist()
+
+
+
+def get_speech_regions(speech_timestamps, start: float, end: float, padding: float = 0.3):
+  """Padded speech segments within [start, end), merged when they touch."""
+  regions = []
+  for timestamp in speech_timestamps:
+    if timestamp['end'] <= start or timestamp['start'] >= end:
+      continue
+    region_start = max(start, timestamp['start'] - padding)
+    region_end = min(end, timestamp['end'] + padding)
+    if regions and region_start <= regions[-1][1]:
+      regions[-1] = (regions[-1][0], max(regions[-1][1], region_end))
+    else:
+      regions.append((region_start, region_end))
+  return regions
+
+
+
+def write_speech_audio(audio: PcmAudio, regions, output_path: Path):
+  # Raw PCM of the regions one after the other, the same format as the extracted audio
+  with open(output_path, "wb") as file:
+    for start, end in regions:
+      first = int(round(start * audio.sample_rate))
+      last = int(round(end * audio.sample_rate))
+      file.write(audio.samples[first:last].tobytes())
+  return output_path
+
+
+
+def restore_subtitle_times(subtitles, offset_map: OffsetMap):
+  """Subtitles timed on the uploaded audio, timed on the chunk again."""
+  if offset_map is None or not subtitles:
+    return subtitles
+  starts = offset_map.to_chunk_time([subtitle['start'] for subtitle in subtitles])
+  ends = offset_map.to_chunk_time([subtitle['end'] for subtitle in subtitles], end = True)
+  return [dict(subtitle, start = float(start), end = float(end)) for subtitle, start, end in zip(subtitles, starts, ends)]
@@ -0,0 +1,264 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import re
+import json
+import time
+import random
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+class FakeGeminiServer:
+  """Local stand-in of the Gemini API answering with schema valid subtitles and translations, directly or in batch jobs, for benchmarks without quota."""
+
+  def __init__(self, latency: float = 0.5, rate_limit_rate: float = 0.0, truncation_rate: float = 0.0, processing_time: float = 1.0, cues_per_request: int = 40, retry_delay: float = 1.0, seed: int = 0, batch_time: float = 2.0, batch_failure_rate: float = 0.0):
+    self.latency = latency
+    self.rate_limit_rate = rate_limit_rate
+    self.truncation_rate = truncation_rate
+    self.processing_time = processing_time
+    self.cues_per_request = cues_per_request
+    self.retry_delay = retry_delay
+    self.batch_time = batch_time
+    self.batch_failure_rate = batch_failure_rate
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.files = {}
+    self.batches = {}
+    self.counter = itertools.count(1)
+    self.stats = {'upload': 0, 'generate': 0, 'rate_limited': 0, 'truncated': 0, 'batch': 0, 'batch_requests': 0, 'batch_failed': 0}
+    self.server = None
+    self.thread = None
+
+
+  @property
+  def base_url(self):
+    host, port = self.server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+  def start(self):
+    # Any free port, served by a background thread
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+    self.server.daemon_threads = True
+    self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+    self.thread.start()
+    return self
+
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def __enter__(self):
+    return self.start()
+
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+
+  def _chance(self, rate: float):
+    with self.lock:
+      return self.random.random() < rate
+
+
+  def _wait(self):
+    # Latency with some jitter, like a real model
+    with self.lock:
+      delay = self.latency * self.random.uniform(0.5, 1.5)
+    time.sleep(delay)
+
+
+  def _reply(self, text: str):
+    # Translations keep the ids of the requested lines
+    if text.startswith("Translate"):
+      lines = json.loads(text[text.index("["):])
+      return {'lines': [{'id': line['id'], 'text': f"Translated {line['text']}"} for line in lines]}
+
+    # Transcriptions resume after the given time when a previous reply was cut
+    match = re.search(r"up to ([0-9.]+) seconds", text)
+    resume_time = float(match.group(1)) if match else 0.0
+    subtitles = []
+    for i in range(self.cues_per_request):
+      start = i * 3.0
+      if start >= resume_time:
+        subtitles.append({'start': start, 'end': start + 2.5, 'text': f"セリフ {i}"})
+    return {'subtitles': subtitles}
+
+
+  def _generate(self, request):
+    # Reply text to the last prompt of the request, cut short at random
+    texts = [part['text'] for content in request['contents'] for part in content['parts'] if 'text' in part]
+    text = json.dumps(self._reply(texts[-1]), ensure_ascii = False)
+    finish_reason = "STOP"
+    if self._chance(self.truncation_rate):
+      with self.lock:
+        text = text[:int(len(text) * self.random.uniform(0.3, 0.9))]
+        self.stats['truncated'] += 1
+      finish_reason = "MAX_TOKENS"
+    return text, finish_reason
+
+
+  def _usage(self, text: str):
+    # Rough counts, enough to exercise the accounting
+    output_tokens = len(text) // 2
+    return {'promptTokenCount': 1000, 'candidatesTokenCount': output_tokens, 'totalTokenCount': 1000 + output_tokens}
+
+
+  def _file(self, name: str):
+    # Files are processed for a while after their upload
+    uploaded_file = self.files[name]
+    state = "ACTIVE" if time.perf_counter() >= uploaded_file['ready'] else "PROCESSING"
+    return dict(uploaded_file['file'], state = state)
+
+
+  def _create_batch(self, model: str, batch):
+    # Every reply is made at once, and given out once the job has run for a while
+    # Some requests fail and some replies are cut short, like in a real job
+    responses = []
+    for request in batch['inputConfig']['requests']['requests']:
+      metadata = request.get('metadata', {})
+      if self._chance(self.batch_failure_rate):
+        with self.lock:
+          self.stats['batch_failed'] += 1
+        responses.append({'error': {'code': 13, 'message': "Internal error while processing the request."}, 'metadata': metadata})
+        continue
+      text, finish_reason = self._generate(request['request'])
+      responses.append({'response': {
+        'candidates'   : [{'content': {'role': "model", 'parts': [{'text': text}]}, 'finishReason': finish_reason}],
+        'usageMetadata': self._usage(text)
+      }, 'metadata': metadata})
+
+    with self.lock:
+      name = f"batches/{next(self.counter)}"
+      self.stats['batch'] += 1
+      self.stats['batch_requests'] += len(responses)
+      self.batches[name] = {
+        'model'       : model,
+        'display_name': batch.get('displayName', ""),
+        'responses'   : responses,
+        'ready'       : time.perf_counter() + self.batch_time
+      }
+    return self._batch(name)
+
+
+  def _batch(self, name: str):
+    # Long running operation of the job, its output once it succeeded
+    batch = self.batches[name]
+    done = time.perf_counter() >= batch['ready']
+    metadata = {
+      '@type'      : "type.googleapis.com/google.ai.generativelanguage.v1beta.GenerateContentBatch",
+      'model'      : batch['model'],
+      'displayName': batch['display_name'],
+      'state'      : "BATCH_STATE_SUCCEEDED" if done else "BATCH_STATE_RUNNING"
+    }
+    if done:
+      metadata['output'] = {'inlinedResponses': {'inlinedResponses': batch['responses']}}
+    return {'name': name, 'metadata': metadata, 'done': done}
+
+
+  def _make_handler(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+
+      def log_message(self, *args):
+        pass
+
+      def send_json(self, code, body, headers = {}):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+          self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+      def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+      def send_stream(self, text, finish_reason):
+        # Server-sent events, a few characters at a time
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        step = 64
+        for i in range(0, len(text), step):
+          last = i + step >= len(text)
+          chunk = {'candidates': [{'content': {'role': "model", 'parts': [{'text': text[i:i + step]}]}}]}
+          if last:
+            chunk['candidates'][0]['finishReason'] = finish_reason
+            chunk['usageMetadata'] = server._usage(text)
+          self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii = False)}\r\n\r\n".encode())
+        self.wfile.flush()
+        self.close_connection = True
+
+      def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self.read_body()
+
+        # Resumable upload, first the start command then the bytes
+        if path.startswith("/upload/") and self.headers.get("X-Goog-Upload-Command", "").startswith("start"):
+          number = next(server.counter)
+          return self.send_json(200, {}, {"X-Goog-Upload-URL": f"{server.base_url}/resumable/{number}"})
+        if path.startswith("/resumable/"):
+          name = f"files/{path.rsplit('/', 1)[1]}"
+          with server.lock:
+            server.stats['upload'] += 1
+            server.files[name] = {
+              'file' : {'name': name, 'uri': f"{server.base_url}/v1beta/{name}", 'mimeType': "audio/mp4", 'sizeBytes': str(len(body))},
+              'ready': time.perf_counter() + server.processing_time
+            }
+          return self.send_json(200, {'file': server._file(name)}, {"X-Goog-Upload-Status": "final"})
+
+        # Generation, maybe refused for exceeding the quota
+        if path.endswith(":generateContent") or path.endswith(":streamGenerateContent"):
+          server._wait()
+          with server.lock:
+            server.stats['generate'] += 1
+          if server._chance(server.rate_limit_rate):
+            with server.lock:
+              server.stats['rate_limited'] += 1
+            return self.send_json(429, {'error': {
+              'code'   : 429,
+              'message': "Resource has been exhausted (e.g. check quota).",
+              'status' : "RESOURCE_EXHAUSTED",
+              'details': [{'@type': "type.googleapis.com/google.rpc.RetryInfo", 'retryDelay': f"{server.retry_delay}s"}]
+            }})
+          text, finish_reason = server._generate(json.loads(body))
+          if path.endswith(":streamGenerateContent"):
+            return self.send_stream(text, finish_reason)
+          return self.send_json(200, {
+            'candidates'   : [{'content': {'role': "model", 'parts': [{'text': text}]}, 'finishReason': finish_reason}],
+            'usageMetadata': server._usage(text)
+          })
+
+        # Batch job of inlined requests
+        if path.endswith(":batchGenerateContent"):
+          model = path[len("/v1beta/"):-len(":batchGenerateContent")]
+          return self.send_json(200, server._create_batch(model, json.loads(body)['batch']))
+
+        self.send_json(404, {'error': {'code': 404, 'message': path, 'status': "NOT_FOUND"}})
+
+      def do_GET(self):
+        path = self.path.split("?")[0]
+        name = path[len("/v1beta/"):]
+        if name in server.files:
+          return self.send_json(200, server._file(name))
+        if name in server.batches:
+          return self.send_json(200, server._batch(name))
+        if name == "models":
+          return self.send_json(200, {'models': [{'name': "models/gemini-3-flash-preview", 'displayName': "Fake Gemini 3 Flash Preview"}]})
+        self.send_json(404, {'error': {'code': 404, 'message': path, 'status': "NOT_FOUND"}})
+
+      def do_DELETE(self):
+        path = self.path.split("?")[0]
+        server.files.pop(path[len("/v1beta/"):], None)
+        self.send_json(200, {})
+
+    return Handler
@@ -1,8 +1,12 @@
 # Written by Chiw the Neko <chiwtheneko@gmail.com>
+import os
+import tempfile
 import subprocess
+from time import perf_counter, sleep
 from pathlib import Path
 from datetime import time
 from path_utils import generate_temporary_path
+from metrics_utils import metrics, read_peak_rss
 
 
 
@@ -12,31 +16,104 @@ class FFmpegError(Exception):
 
 
 
+# The whole pipeline works on raw 16kHz mono signed 16-bit PCM
+pcm_sample_rate = 16000
+pcm_input_args = ["-f", "s16le", "-ar", str(pcm_sample_rate), "-ac", "1"]
+
+
+
+# File extension and muxer of each upload format
+upload_extensions = {
+  "mp4" : "mp4",
+  "mp3" : "mp3",
+  "opus": "ogg",
+  "flac": "flac",
+}
+# MIME type of each extension, for the chunks sent inline
+upload_mime_types = {
+  "mp4" : "video/mp4",
+  "mp3" : "audio/mpeg",
+  "ogg" : "audio/ogg",
+  "flac": "audio/flac",
+}
+
+
+
+# Same samples, same bytes: without these the muxers write random stream serials and creation times, and the cache key of a chunk would change on every run
+bitexact_args = ["-fflags", "+bitexact", "-flags:a", "+bitexact", "-flags:v", "+bitexact"]
+
+
+
 def format_ffmpeg_time(t: time):
   """Converts a python time object to HH:MM:SS.mmm string"""
   return t.strftime("%H:%M:%S.%f")[:-3]
 
 
 
+def run_command(command, operation: str):
+  # Same as subprocess.run(check = True), also recording the wall time, the CPU time and the peak memory of this process alone
+  # Its output goes to temporary files so that wait4 can reap it and give its resource usage
+  start_time = perf_counter()
+  with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+    process = subprocess.Popen(command, stdout = stdout, stderr = stderr)
+
+    # The peak memory given by wait4 counts the memory of this process the child started from, its own is read while it runs
+    peak_rss = None
+    while True:
+      pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+      if pid != 0:
+        break
+      peak_rss = read_peak_rss(process.pid, Path(command[0]).name) or peak_rss
+      sleep(0.01)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    stdout.seek(0)
+    stderr.seek(0)
+    output = stdout.read().decode(errors = "replace")
+    error_output = stderr.read().decode(errors = "replace")
+
+  metrics.observe("ffmpeg_wall_seconds", perf_counter() - start_time, operation = operation)
+  metrics.observe("ffmpeg_cpu_seconds", usage.ru_utime + usage.ru_stime, operation = operation)
+  if peak_rss is not None:
+    metrics.observe("ffmpeg_max_rss_bytes", peak_rss, operation = operation)
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, command, output, error_output)
+  return subprocess.CompletedProcess(command, process.returncode, output, error_output)
+
+
+
+def get_input_args(audio_path: Path):
+  # Raw PCM has no header, so ffmpeg must be told its format
+  if audio_path.suffix == ".pcm":
+    return pcm_input_args + ["-i", audio_path]
+  return ["-i", audio_path]
+
+
+
+def get_black_video_args(duration: float):
+  # Black video track as long as the audio, open ended it stops at a different frame on every run
+  return ["-f", "lavfi", "-i", f"color=c=black:s=640x480:r=24:d={duration:.3f}"]
+
+
+
 def extract_all_audio(video_path: Path, working_dir: Path):
-  # Generate a unique filename for this specific clip
-  output_path = generate_temporary_path(working_dir, "mp3")
+  # Decode once into raw PCM, every later step reads this file instead of decoding again
+  output_path = generate_temporary_path(working_dir, "pcm")
 
   command = [
     "ffmpeg", "-hide_banner", "-loglevel", "level+error",
     "-i", video_path,
     "-vn",  # No video
     "-ac", "1",  # <--- FORCED MONO
-    "-ar", "16000",  # <--- FORCED 16kHz
-    "-c:a", "libmp3lame",
+    "-ar", str(pcm_sample_rate),  # <--- FORCED 16kHz
     "-af", "loudnorm",  # Normalize volume
-    "-q:a", "2",  # High quality VBR
+    "-f", "s16le",  # Raw samples, no lossy intermediate
+    "-c:a", "pcm_s16le",
     "-y",  # Overwrite output
     output_path
   ]
 
   try:
-    subprocess.run(command, capture_output = True, text = True, check = True)
+    run_command(command, "extract_audio")
     return output_path
   except subprocess.CalledProcessError as e:
     print(f"FFmpeg Error: {e.stderr}")
@@ -52,14 +129,41 @@ def get_file_duration(file_path: Path):
     "-of", "default=noprint_wrappers=1:nokey=1",
     file_path
   ]
-  result = subprocess.run(command, capture_output = True, text = True, check = True)
+  result = run_command(command, "probe")
   return float(result.stdout.strip())
 
 
 
-def extract_audio_as_video(audio_path: Path, start_time: float, end_time: float, working_dir: Path):
+def get_input_duration(audio_path: Path):
+  # Raw PCM gives its duration by its size
+  if audio_path.suffix == ".pcm":
+    return audio_path.stat().st_size / 2 / pcm_sample_rate
+  return get_file_duration(audio_path)
+
+
+
+def get_upload_codec_args(upload_format: str, bitrate: str = None):
+  # The MP4 container wraps the audio with a synthetic black video track
+  if upload_format in ("mp4", "mp3"):
+    if bitrate is None:
+      return ["-c:a", "libmp3lame", "-q:a", "2"]
+    return ["-c:a", "libmp3lame", "-b:a", bitrate]
+
+  # Opus is the most compact for speech
+  if upload_format == "opus":
+    return ["-c:a", "libopus", "-application", "voip", "-b:a", bitrate or "24k"]
+
+  # FLAC is lossless, the bitrate does not apply
+  if upload_format == "flac":
+    return ["-c:a", "flac"]
+
+  raise ValueError(f"Unknown upload format: {upload_format}")
+
+
+
+def extract_chunk(audio_path: Path, start_time: float, end_time: float, working_dir: Path, upload_format: str = "mp4", bitrate: str = None):
   # Generate a unique filename for this specific clip
-  output_path = generate_temporary_path(working_dir, "mp4")
+  output_path = generate_temporary_path(working_dir, upload_extensions[upload_format])
 
   print("generate ", start_time, end_time)
 
@@ -67,20 +171,80 @@ def extract_audio_as_video(audio_path: Path, start_time: float, end_time: float,
     "ffmpeg", "-hide_banner", "-loglevel", "level+error",
     "-ss", str(start_time),
     "-to", str(end_time),
-    "-i", audio_path,
-    "-f", "lavfi",
-    "-i", "color=c=black:s=640x480:r=24",
-    "-tune", "stillimage",
-    "-pix_fmt", "yuv420p",
-    "-c:a", "copy",
-    "-shortest",
-    output_path
   ]
+  command += get_input_args(audio_path)
+  if upload_format == "mp4":
+    command += get_black_video_args(end_time - start_time)
+    command += [
+      "-tune", "stillimage",
+      "-pix_fmt", "yuv420p",
+      "-shortest",
+    ]
+  command += get_upload_codec_args(upload_format, bitrate)
+  command += bitexact_args
+  command += [output_path]
 
   try:
-    subprocess.run(command, capture_output = True, text = True, check = True)
+    run_command(command, "extract_chunk")
     return output_path
   except subprocess.CalledProcessError as e:
     print(f"FFmpeg Error: {e.stderr}")
     error_message = e.stderr.strip() or "Unknown FFmpeg error"
     raise FFmpegError(f"FFmpeg failed with exit code {e.returncode}: {error_message}")
+
+
+
+def extract_chunks(audio_path: Path, splits, working_dir: Path, upload_format: str = "mp4", bitrate: str = None):
+  # All the chunks go into their own directory
+  output_dir = generate_temporary_path(working_dir, "chunks")
+  output_dir.mkdir()
+  list_path = output_dir / "chunks.csv"
+  split_times = ",".join(f"{split:.3f}" for split in splits)
+
+  # Cut every chunk in a single pass, splitting on the audio frames closest to the split points
+  command = ["ffmpeg", "-hide_banner", "-loglevel", "level+error"]
+  command += get_input_args(audio_path)
+  if upload_format == "mp4":
+    command += get_black_video_args(get_input_duration(audio_path))
+    command += [
+      "-map", "1:v",
+      "-map", "0:a",
+      "-tune", "stillimage",
+      "-pix_fmt", "yuv420p",
+      "-shortest",
+    ]
+    if splits:
+      command += ["-force_key_frames", split_times]
+  command += get_upload_codec_args(upload_format, bitrate)
+  command += bitexact_args
+  command += [
+    "-f", "segment",
+    "-segment_format", upload_extensions[upload_format],
+    "-reference_stream", "a:0",
+    "-reset_timestamps", "1",
+    "-segment_list", list_path,
+    "-segment_list_type", "csv",
+  ]
+  if splits:
+    command += ["-segment_times", split_times]
+  else:
+    command += ["-segment_time", "86400"]
+  command += [output_dir / f"chunk%05d.{upload_extensions[upload_format]}"]
+
+  try:
+    run_command(command, "extract_chunks")
+  except subprocess.CalledProcessError as e:
+    print(f"FFmpeg Error: {e.stderr}")
+    error_message = e.stderr.strip() or "Unknown FFmpeg error"
+    raise FFmpegError(f"FFmpeg failed with exit code {e.returncode}: {error_message}")
+
+  # The segment list gives the exact offsets at which each chunk was cut
+  chunks = []
+  for line in list_path.read_text().splitlines():
+    file_name, start, end = line.rsplit(",", 2)
+    chunks.append({
+      'start': float(start),
+      'end'  : float(end),
+      'audio': output_dir / file_name
+    })
+  return chunks
@@ -2,32 +2,87 @@
 import time
 import random
 import json
+import threading
+import httpx
 import google.api_core.exceptions
 from pathlib import Path
 from google import genai
 from google.genai import errors
 from google.genai import types
 from exception_utils import get_fqn
+from rate_limit_utils import RateLimiter
+from cache_utils import ResultCache, hash_file, make_cache_key
+from json_utils import IncrementalArrayParser, TruncatedArray
+from subtitle_utils import as_subtitle_track
+from metrics_utils import metrics
 
 
 
 gemini_model = "gemini-3-flash-preview"
 
+# Quotas per model, requests per minute and tokens per minute
+default_model_limits = {
+  "gemini-3-flash-preview": (10, 250000),
+}
+# Quotas in use, the defaults unless the job overrides them
+model_limits = dict(default_model_limits)
+
+# Gemini bills audio at a fixed rate of 32 tokens per second
+audio_tokens_per_second = 32
+
+# Limiter shared by every worker so that concurrent calls stay under the quota
+_rate_limiter = None
+
+# Cache of parsed results, None when caching is disabled
+_result_cache = None
+
+# How often translations came back complete, were repaired line by line, or had to be requested again
+translation_stats = {
+  'complete'      : 0,
+  'repaired'      : 0,
+  'repaired_lines': 0,
+  'full_retries'  : 0,
+}
+_translation_stats_lock = threading.Lock()
+
+# Client shared by every stage, so that connections are kept alive between calls
+_client = None
+_client_lock = threading.Lock()
+
 transcription_instruction = """
 You are a high-accuracy Japanese subtitle generator.
 """
 
+# Language names of the target codes, unknown codes are given to the model as they are
+language_names = {
+  "en": "English",
+  "fr": "French",
+  "de": "German",
+  "es": "Spanish",
+  "it": "Italian",
+  "pt": "Portuguese",
+  "ru": "Russian",
+  "pl": "Polish",
+  "nl": "Dutch",
+  "ko": "Korean",
+  "zh": "Chinese",
+  "id": "Indonesian",
+  "vi": "Vietnamese",
+  "th": "Thai",
+  "ar": "Arabic",
+}
+
 translation_instruction = """
-You are an expert Japanese-to-English subtitle translator.
+You are an expert Japanese-to-{language} subtitle translator.
 
-Your goal is to provide natural, idiomatic English translations while preserving Japanese naming conventions and honorifics to maintain cultural authenticity.
+Your goal is to provide natural, idiomatic {language} translations while preserving Japanese naming conventions and honorifics to maintain cultural authenticity.
 
 SPECIFIC INSTRUCTIONS:
 1. HONORIFIC RETENTION: DO NOT translate or remove Japanese honorifics. Keep suffixes such as "-san", "-kun", "-chan", "-sama", "-senpai", "-kohai", and "-dono" attached to the names.
    - Example: "田中さん" should remain as "Tanaka-san".
    - Always maintain the original Japanese name order (Surname first) when followed by an honorific.
 2. TITLES: Keep titles like "Sensei" or "Bucho" if used as a form of address after a name.
-3. CONTEXTUAL FLOW: Even though you are keeping Japanese honorifics, ensure the rest of the sentence is natural English.
+3. CONTEXTUAL FLOW: Even though you are keeping Japanese honorifics, ensure the rest of the sentence is natural {language}.
    - Example: "佐藤くん、どこに行くの？" -> "Sato-kun, where are you going?"
 4. IDIOMS: Do not translate literally. If a character says "Otsukaresama," translate it contextually as "Good job today," "I'm heading out," or "See you later.
 5. SUBTITLE FORMATTING:
@@ -65,11 +120,161 @@ def safe_json_loads(json_string, default = None):
 
 
 
-def generate_with_retry(client: genai.Client, config: types.GenerateContentConfig, content, expected_key: str, expected_nb: int = -1, max_retries = 10):
-  def wait_a_little(nb_attempt):
+def create_client(api_key: str, pool_size: int = 10, base_url: str = None):
+  # Size the connection pool for the number of concurrent workers
+  # The base URL can point to a local stand-in of the API
+  http_options = types.HttpOptions(
+    base_url = base_url,
+    client_args = {
+      'limits': httpx.Limits(max_connections = pool_size, max_keepalive_connections = pool_size)
+    }
+  )
+  return genai.Client(api_key = api_key, http_options = http_options)
+
+
+
+def get_client(api_key: str = None, pool_size: int = 10, base_url: str = None):
+  global _client
+  with _client_lock:
+    if _client is None:
+      if not api_key:
+        raise ValueError("GEMINI_API_KEY not found in environment variables!")
+      _client = create_client(api_key, pool_size, base_url)
+  return _client
+
+
+
+def set_client(client: genai.Client):
+  # Replace the shared client, e.g. with a local fake
+  global _client
+  with _client_lock:
+    _client = client
+
+
+
+def get_rate_limiter():
+  global _rate_limiter
+  if _rate_limiter is None:
+    _rate_limiter = RateLimiter(*model_limits[gemini_model])
+    for model, (rpm, tpm) in model_limits.items():
+      _rate_limiter.set_limits(model, rpm, tpm)
+  return _rate_limiter
+
+
+
+def configure_rate_limits(rpm: int = None, tpm: int = None):
+  # Override the quota of the current model, e.g. for a paid tier
+  # What is not given goes back to the default, so the overrides of a job never outlive it in a resident process
+  default_rpm, default_tpm = default_model_limits[gemini_model]
+  model_limits[gemini_model] = (rpm or default_rpm, tpm or default_tpm)
+  get_rate_limiter().set_limits(gemini_model, *model_limits[gemini_model])
+
+
+
+def set_result_cache(cache: ResultCache):
+  global _result_cache
+  _result_cache = cache
+
+
+
+def get_cached_result(cache_key: str):
+  if _result_cache is None or cache_key is None:
+    return None
+  return _result_cache.get(cache_key)
+
+
+
+def put_cached_result(cache_key: str, result):
+  if _result_cache is not None and cache_key is not None:
+    _result_cache.put(cache_key, result)
+
+
+
+def get_request_cache_key(config: types.GenerateContentConfig, *parts):
+  # The config holds the system instruction, the schema and the generation parameters
+  return make_cache_key(gemini_model, config.model_dump_json(exclude_none = True), *parts)
+
+
+
+def estimate_text_tokens(text: str):
+  # Rough upper bound, Japanese text is close to one token per character and other text to one per four
+  wide = sum(1 for character in text if ord(character) >= 0x3000)
+  return wide + (len(text) - wide) // 4 + 1
+
+
+
+def record_usage(usage_metadata: types.GenerateContentResponseUsageMetadata, request: str):
+  # Tokens billed for a request, to size the quota
+  if usage_metadata is None:
+    return
+  metrics.count("tokens", usage_metadata.prompt_token_count or 0, request = request, kind = "prompt")
+  metrics.count("tokens", usage_metadata.candidates_token_count or 0, request = request, kind = "output")
+  metrics.count("tokens", usage_metadata.total_token_count or 0, request = request, kind = "total")
+
+
+
+def get_retry_delay(error: Exception):
+  # Look for the RetryInfo hint in the error payload, e.g. {"retryDelay": "37s"}
+  details = getattr(error, "details", None)
+  if isinstance(details, dict):
+    for detail in details.get("error", {}).get("details", []):
+      retry_delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+      if retry_delay:
+        return float(retry_delay.rstrip("s"))
+
+  # Fallback on the Retry-After HTTP header
+  response = getattr(error, "response", None)
+  headers = getattr(response, "headers", None)
+  if headers is not None and headers.get("retry-after"):
+    try:
+      return float(headers.get("retry-after"))
+    except ValueError:
+      pass
+
+  return None
+
+
+
+def stream_array(client: genai.Client, config: types.GenerateContentConfig, content, expected_key: str, on_item = None):
+  # Parse the items of the array as the reply arrives
+  parser = IncrementalArrayParser(expected_key)
+  finish_reason = None
+  usage_metadata = None
+  try:
+    for chunk in client.models.generate_content_stream(
+      model = gemini_model,
+      config = config,
+      contents = content
+    ):
+      if chunk.usage_metadata is not None:
+        usage_metadata = chunk.usage_metadata
+      if chunk.candidates and chunk.candidates[0].finish_reason is not None:
+        finish_reason = chunk.candidates[0].finish_reason
+      if chunk.text:
+        for item in parser.feed(chunk.text):
+          if on_item is not None:
+            on_item(item)
+
+  # The connection was cut, keep what already arrived
+  except (httpx.HTTPError, errors.ServerError) as e:
+    if not parser.items:
+      raise
+    print(f"Stream interrupted: {get_fqn(e)}: {e}")
+
+  if parser.complete:
+    return parser.items, finish_reason, usage_metadata
+  return TruncatedArray(parser.items), finish_reason, usage_metadata
+
+
+
+def generate_with_retry(client: genai.Client, config: types.GenerateContentConfig, content, expected_key: str, expected_nb: int = -1, max_retries = 10, estimated_tokens: int = 0, stream: bool = False, on_item = None, accept_partial: bool = False):
+  rate_limiter = get_rate_limiter()
+
+  def wait_a_little(nb_attempt, reason):
     # Exponential backoff: 2, 4, 8, 16, 32... seconds
     # Plus "jitter" (a random decimal) to smooth out traffic spikes
     wait_time = (2 ** nb_attempt) + random.random()
+    metrics.count("retries", request = expected_key, reason = reason)
 
     print(f"Retrying in {wait_time:.2f} seconds (Attempt {nb_attempt + 1}/{max_retries})...")
 
@@ -79,16 +284,49 @@ def generate_with_retry(client: genai.Client, config: types.GenerateContentConfi
   # Try several times if needed
   for attempt in range(max_retries):
     try:
+      # Wait for our turn in the quota
+      ticket = rate_limiter.acquire(gemini_model, estimated_tokens)
+      metrics.count("requests", request = expected_key, mode = "stream" if stream else "direct")
+
+      # Streamed reply, the items are handed to on_item as soon as they are complete
+      if stream:
+        array, finish_reason, usage_metadata = stream_array(client, config, content, expected_key, on_item)
+        record_usage(usage_metadata, expected_key)
+        if usage_metadata is not None:
+          rate_limiter.settle(ticket, usage_metadata.total_token_count)
+
+        # Return array of data
+        if not isinstance(array, TruncatedArray) and (expected_nb < 0 or len(array) == expected_nb):
+          return array
+
+        # Keep the items received before the reply was cut, the caller requests the rest
+        if isinstance(array, TruncatedArray) and accept_partial and len(array) > 0:
+          print(f"Response truncated ({finish_reason}), keeping {len(array)} items.")
+          metrics.count("truncated_replies", request = expected_key)
+          return array
+
+        # If parsing failed or we didn't get the data we expected then try again with a higher temperature
+        config.temperature += 0.1
+        metrics.count("retries", request = expected_key, reason = "parse")
+        metrics.count("temperature_bumps", request = expected_key)
+        print(f"Failed to parse streamed response ({finish_reason}). Retrying with higher temperature {config.temperature}.")
+        continue
+
       response = client.models.generate_content(
         model = gemini_model,
         config = config,
         contents = content
       )
 
+      # Account for the tokens that were really used
+      if response is not None and response.usage_metadata is not None:
+        record_usage(response.usage_metadata, expected_key)
+        rate_limiter.settle(ticket, response.usage_metadata.total_token_count)
+
       # Try again if response was None
       if response is None:
         print("No response received.")
-        wait_a_little(attempt)
+        wait_a_little(attempt, "no_response")
 
       # If text is None then check the reason
       elif response.text is None or response.text == "":
@@ -108,7 +346,7 @@ def generate_with_retry(client: genai.Client, config: types.GenerateContentConfi
             print("The model started quoting copyrighted material and stopped.")
           elif finish_reason == "OTHER":
             print("The model collapsed or the server cut the connection.")
-        wait_a_little(attempt)
+        wait_a_little(attempt, "empty")
 
       # We got a response and it should be JSON, try to parse it
       else:
@@ -125,11 +363,22 @@ def generate_with_retry(client: genai.Client, config: types.GenerateContentConfi
           if array is not None and (expected_nb < 0 or len(array) == expected_nb):
             return array
 
+        # The reply was cut, keep its complete items and let the caller request the rest
+        elif accept_partial:
+          parser = IncrementalArrayParser(expected_key)
+          parser.feed(clean_json)
+          if parser.items:
+            print(f"Response truncated, keeping {len(parser.items)} items.")
+            metrics.count("truncated_replies", request = expected_key)
+            return TruncatedArray(parser.items)
+
         # If parsing failed or we didn't get the data we expected then try again with a higher temperature
         config.temperature += 0.1
+        metrics.count("retries", request = expected_key, reason = "parse")
+        metrics.count("temperature_bumps", request = expected_key)
         print(f"Failed to parse response. Retrying with higher temperature {config.temperature}.")
 
-    except google.genai.errors.ServerError as e:
+    except errors.APIError as e:
       # Model not found
       if e.code == 404:
         print(f"Model {gemini_model} was not found.")
@@ -140,22 +389,38 @@ def generate_with_retry(client: genai.Client, config: types.GenerateContentConfi
         print("Model denied permission.")
         raise
 
-      # Resource exhausted
+      # Resource exhausted, hold every worker for as long as the server asks
       elif e.code == 429:
-        print("Resource exhausted. Waiting longer...")
-        time.sleep(65 + (random.random() * 10))
+        retry_delay = get_retry_delay(e)
+        if retry_delay is None:
+          retry_delay = (2 ** attempt) + random.random()
+        print(f"Resource exhausted. Waiting {retry_delay:.2f} seconds...")
+        metrics.count("retries", request = expected_key, reason = "rate_limited")
+        metrics.observe("rate_limit_wait_seconds", retry_delay)
+        rate_limiter.backoff(gemini_model, retry_delay)
+
+      # Other client errors will fail again
+      elif e.code < 500:
+        print(f"GenAI Error ({e.code}): {e.message}")
+        raise
 
       # Other error, treat it as temporary and try again
       else:
         print(f"Temporary GenAI Error ({e.code}): {e.message}")
-        wait_a_little(attempt)
+        wait_a_little(attempt, "server_error")
 
     # Other possible temporary errors
+    except google.api_core.exceptions.TooManyRequests as e:
+      retry_delay = get_retry_delay(e) or (2 ** attempt) + random.random()
+      print(f"Resource exhausted ({e.code}). Waiting {retry_delay:.2f} seconds...")
+      metrics.count("retries", request = expected_key, reason = "rate_limited")
+      metrics.observe("rate_limit_wait_seconds", retry_delay)
+      rate_limiter.backoff(gemini_model, retry_delay)
+
     except (google.api_core.exceptions.ServiceUnavailable,
-            google.api_core.exceptions.InternalServerError,
-            google.api_core.exceptions.TooManyRequests) as e:
+            google.api_core.exceptions.InternalServerError) as e:
       print(f"Temporary Google Error ({e.code}): {e.message}")
-      wait_a_little(attempt)
+      wait_a_little(attempt, "server_error")
 
     except google.api_core.exceptions.InvalidArgument as e:
       print(f"Fatal Error: Your prompt or file is invalid. Check your parameters. {e}")
@@ -173,8 +438,7 @@ def generate_with_retry(client: genai.Client, config: types.GenerateContentConfi
 
 
 
-def display_available_models(api_key: str):
-  client = genai.Client(api_key = api_key)
+def display_available_models(client: genai.Client):
   print("--- Available Models ---")
   for model in client.models.list():
     # 'name' is what you use in your generate_content calls
@@ -183,16 +447,31 @@ def display_available_models(api_key: str):
 
 
 
-def upload(client: genai.Client, file_path: Path):
+def upload(client: genai.Client, file_path: Path, wait: bool = True):
   # Upload the file to the Media API
   print(f"Uploading {file_path.name}...")
   path_str = str(file_path.resolve())
+  start_time = time.perf_counter()
   uploaded_file = client.files.upload(file = path_str)
+  metrics.observe("upload_seconds", time.perf_counter() - start_time)
+  metrics.count("upload_bytes", file_path.stat().st_size)
+  if not wait:
+    return uploaded_file
 
   # Wait for the file to be processed
+  start_time = time.perf_counter()
+  uploaded_file = wait_for_file(client, uploaded_file)
+  metrics.observe("upload_wait_seconds", time.perf_counter() - start_time)
+  return uploaded_file
+
+
+
+def wait_for_file(client: genai.Client, uploaded_file: types.File, delay: float = 0.5, max_delay: float = 10):
+  # Short files are ready in a moment, poll often at first then back off
   while uploaded_file.state.name == "PROCESSING":
     print(".", end = "", flush = True)
-    time.sleep(2)
+    time.sleep(delay)
+    delay = min(delay * 2, max_delay)
     uploaded_file = client.files.get(name = uploaded_file.name)
 
   # If uploading failed
@@ -203,70 +482,88 @@ def upload(client: genai.Client, file_path: Path):
 
 
 
-def transcribe(audio_path: Path, api_key: str):
-  client = genai.Client(api_key = api_key)
-
-  # Upload audio clip to Google server
-  audio_file = upload(client, audio_path)
-
-  # Request Transcription
-  try:
-    print("Transcribing...")
-
-    # Reply schema
-    subtitle_schema = {
-      "type"      : "OBJECT",
-      "properties": {
-        "subtitles": {
-          "type" : "ARRAY",
-          "items": {
-            "type"      : "OBJECT",
-            "properties": {
-              "start": {
-                "type"       : "NUMBER",
-                "description": "Time at which the segment begins in seconds (e.g., 12.45)",
-                "minimum"    : 0
-              },
-              "end"  : {
-                "type"       : "NUMBER",
-                "description": "End at which the segment ends in seconds (e.g., 15.10)",
-                "minimum"    : 0
-              },
-              "text" : {
-                "type"       : "STRING",
-                "description": "The transcribed text for this segment"
-              }
+def get_transcription_request():
+  # Reply schema
+  subtitle_schema = {
+    "type"      : "OBJECT",
+    "properties": {
+      "subtitles": {
+        "type" : "ARRAY",
+        "items": {
+          "type"      : "OBJECT",
+          "properties": {
+            "start": {
+              "type"       : "NUMBER",
+              "description": "Time at which the segment begins in seconds (e.g., 12.45)",
+              "minimum"    : 0
+            },
+            "end"  : {
+              "type"       : "NUMBER",
+              "description": "End at which the segment ends in seconds (e.g., 15.10)",
+              "minimum"    : 0
             },
-            "required"  : ["start", "end", "text"]
-          }
+            "text" : {
+              "type"       : "STRING",
+              "description": "The transcribed text for this segment"
+            }
+          },
+          "required"  : ["start", "end", "text"]
         }
-      },
-      "required"  : ["subtitles"]
-    }
+      }
+    },
+    "required"  : ["subtitles"]
+  }
+
+  # Config
+  config = types.GenerateContentConfig(
+    response_mime_type = "application/json",
+    response_schema = subtitle_schema,
+    safety_settings = safety_settings,
+    system_instruction = transcription_instruction,
+    media_resolution = types.MediaResolution.MEDIA_RESOLUTION_LOW,
+    top_p = 0.9,
+    temperature = 0.1
+  )
+
+  # Prompt
+  prompt = "Generate highly accurate Japanese transcription of this video clip into JSON subtitles."
+
+  return config, prompt
+
+
+
+def get_transcription_cache_key(audio_path: Path):
+  # Same audio, model, prompt and config give the same transcription
+  config, prompt = get_transcription_request()
+  return get_request_cache_key(config, prompt, hash_file(audio_path))
+
+
 
-    # Config
-    config = types.GenerateContentConfig(
-      response_mime_type = "application/json",
-      response_schema = subtitle_schema,
-      safety_settings = safety_settings,
-      system_instruction = transcription_instruction,
-      media_resolution = types.MediaResolution.MEDIA_RESOLUTION_LOW,
-      top_p = 0.9,
-      temperature = 0.1
-    )
-
-    # Content
+def transcribe_file(client: genai.Client, audio_file: types.File, duration: float = 0, cache_key: str = None, stream: bool = False, on_subtitle = None, max_continuations: int = 5):
+  # Request Transcription
+  print("Transcribing...")
+  config, prompt = get_transcription_request()
+  estimated_tokens = int(duration * audio_tokens_per_second * 2)
+
+  subtitle_list = []
+  resume_time = 0
+  for _ in range(max_continuations + 1):
+    # Content, asking for the remainder only when a previous reply was cut
     content = [
-      "Generate highly accurate Japanese transcription of this video clip into JSON subtitles.",
+      prompt if resume_time == 0 else f"{prompt} The clip is already transcribed up to {resume_time:.2f} seconds, only transcribe what comes after. Timestamps stay relative to the beginning of the clip.",
       audio_file
     ]
 
     # Send request to Gemini
-    subtitle_list = generate_with_retry(client, config, content, "subtitles")
+    subtitles = generate_with_retry(client, config, content, "subtitles", estimated_tokens = estimated_tokens, stream = stream, on_item = on_subtitle, accept_partial = True)
 
-  # Delete audio file from server
-  finally:
-    client.files.delete(name = audio_file.name)
+    # Only keep what comes after the last good timestamp
+    truncated = isinstance(subtitles, TruncatedArray)
+    subtitles = [subtitle for subtitle in subtitles if subtitle['start'] >= resume_time]
+    subtitle_list.extend(subtitles)
+    if not truncated or not subtitles:
+      break
+    resume_time = subtitles[-1]['end']
 
   # Add indices
   i = 1
@@ -274,27 +571,56 @@ def transcribe(audio_path: Path, api_key: str):
     subtitle['index'] = i
     i += 1
 
+  # Remember the result for the next runs, unless the end of the clip is still missing
+  if truncated:
+    print(f"Warning: Transcription still cut short after {max_continuations} continuations, it ends at {resume_time:.2f} seconds and is not cached.")
+  else:
+    put_cached_result(cache_key, subtitle_list)
+
   # Return list of transcribed subtitles
   return subtitle_list
 
 
 
-def translate(subtitles, api_key: str):
-  client = genai.Client(api_key = api_key)
+def transcribe(client: genai.Client, audio_path: Path, duration: float = 0):
+  # Skip everything if this audio was already transcribed
+  cache_key = get_transcription_cache_key(audio_path)
+  cached = get_cached_result(cache_key)
+  if cached is not None:
+    return cached
 
-  # List subtitle lines, without indices and timestamps
-  lines = []
-  for subtitle in subtitles:
-    lines.append({
-      'text': subtitle['text']
-    })
-
-  # Dump JSON of all lines
-  lines_dump = json.dumps(lines, ensure_ascii = False, indent = 2)
+  # Upload audio clip to Google server
+  audio_file = upload(client, audio_path)
 
   # Request Transcription
-  print("Translating...")
+  try:
+    return transcribe_file(client, audio_file, duration, cache_key)
+
+  # Delete audio file from server
+  finally:
+    client.files.delete(name = audio_file.name)
+
+
+
+def record_translation_stat(name: str, count: int = 1):
+  with _translation_stats_lock:
+    translation_stats[name] += count
+
+
+
+def reset_translation_stats():
+  with _translation_stats_lock:
+    for name in translation_stats:
+      translation_stats[name] = 0
 
+
+
+def get_language_name(target: str):
+  return language_names.get(target, target)
+
+
+
+def get_translation_config(temperature: float = 0.3, target: str = "en"):
   # Reply schema
   translation_schema = {
     "type"      : "OBJECT",
@@ -304,12 +630,16 @@ def translate(subtitles, api_key: str):
         "items": {
           "type"      : "OBJECT",
           "properties": {
+            "id"  : {
+              "type"       : "INTEGER",
+              "description": "The id of the source line"
+            },
             "text": {
               "type"       : "STRING",
               "description": "The translated text for this line"
             }
           },
-          "required"  : ["text"]
+          "required"  : ["id", "text"]
         }
       }
     },
@@ -317,34 +647,130 @@ def translate(subtitles, api_key: str):
   }
 
   # Config
-  config = types.GenerateContentConfig(
+  return types.GenerateContentConfig(
     response_mime_type = "application/json",
     response_schema = translation_schema,
     safety_settings = safety_settings,
-    system_instruction = translation_instruction,
+    system_instruction = translation_instruction.format(language = get_language_name(target)),
     top_p = 0.9,
-    temperature = 0.3
+    temperature = temperature
   )
 
+
+
+def get_translation_content(lines, context_before = None, context_after = None, target: str = "en"):
+  # Dump JSON of all lines, the ids let us match the reply line by line
+  lines_dump = json.dumps(lines, ensure_ascii = False, indent = 2)
+
   # Content
-  content = [
-    f"Translate these lines from Japanese to English: {lines_dump}"
-  ]
+  content = []
+
+  # Neighboring lines help with the flow, but must not be translated
+  if context_before or context_after:
+    context_dump = json.dumps({
+      'before': context_before or [],
+      'after' : context_after or []
+    }, ensure_ascii = False, indent = 2)
+    content.append(f"For context only, these lines come right before and right after the lines to translate. Do NOT translate them and do NOT include them in your reply: {context_dump}")
+
+  content.append(f"Translate these lines from Japanese to {get_language_name(target)}, keeping the id of each line: {lines_dump}")
+  return content
+
+
+
+def get_translation_cache_key(lines, context_before = None, context_after = None, target: str = "en"):
+  # Same lines in the same context give the same translation, the config holds the target language
+  return get_request_cache_key(get_translation_config(target = target), json.dumps([lines, context_before, context_after], ensure_ascii = False))
+
+
+
+def request_translations(client: genai.Client, lines, context_before = None, context_after = None, temperature: float = 0.3, stream: bool = False, target: str = "en"):
+  # Request Translation
+  print(f"Translating to {get_language_name(target)}...")
+  config = get_translation_config(temperature, target)
+  content = get_translation_content(lines, context_before, context_after, target)
 
   # Send request to Gemini
-  translated_lines = generate_with_retry(client, config, content, "lines", expected_nb = len(subtitles))
-
-  # Recreate subtitles from the translated lines
-  translated_subtitles = []
-  for i in range(0, len(subtitles)):
-    subtitle = subtitles[i]
-    translation = translated_lines[i]
-    translated_subtitles.append({
-      'index': subtitle['index'],
-      'start': subtitle['start'],
-      'end'  : subtitle['end'],
-      'text' : translation['text'],
-    })
-
-  # Return list of translated subtitles
-  return translated_subtitles
+  estimated_tokens = estimate_text_tokens(config.system_instruction + "".join(content)) * 2
+  # A truncated stream is fine, the missing lines are requested again
+  return generate_with_retry(client, config, content, "lines", estimated_tokens = estimated_tokens, stream = stream, accept_partial = True)
+
+
+
+def align_translations(lines, translated_lines):
+  # Keep the translations whose id matches exactly one requested line
+  requested_ids = {line['id'] for line in lines}
+  seen = {}
+  for translated_line in translated_lines:
+    line_id = translated_line.get('id') if isinstance(translated_line, dict) else None
+    if line_id in requested_ids and isinstance(translated_line.get('text'), str):
+      seen.setdefault(line_id, []).append(translated_line['text'])
+
+  # An id given twice means lines were merged or shifted, ask for it again
+  return {line_id: texts[0] for line_id, texts in seen.items() if len(texts) == 1}
+
+
+
+def translate_lines(client: genai.Client, texts, context_before = None, context_after = None, max_attempts: int = 6, context_lines: int = 3, stream: bool = False, target: str = "en"):
+  if not texts:
+    return []
+  lines = [{'id': i, 'text': text} for i, text in enumerate(texts)]
+
+  # Skip everything if these lines were already translated
+  cache_key = get_translation_cache_key(lines, context_before, context_after, target)
+  cached = get_cached_result(cache_key)
+  if cached is not None:
+    return cached
+
+  translations = {}
+  missing = lines
+  before = context_before
+  after = context_after
+  temperature = 0.3
+  for attempt in range(max_attempts):
+    matched = align_translations(missing, request_translations(client, missing, before, after, temperature, stream, target))
+    translations.update(matched)
+
+    # Everything is there
+    if len(matched) == len(missing):
+      record_translation_stat('complete' if attempt == 0 else 'repaired')
+      break
+
+    partial = len(matched) >= len(missing) / 2
+    missing = [line for line in missing if line['id'] not in translations]
+
+    # Keep what matched and only ask for the rest
+    if partial:
+      record_translation_stat('repaired_lines', len(missing))
+      print(f"{len(missing)} lines missing. Requesting them again.")
+
+    # Most of the reply is unusable, try again at a higher temperature
+    else:
+      record_translation_stat('full_retries')
+      temperature += 0.1
+      print(f"Only {len(matched)} lines matched. Retrying with higher temperature {temperature:.1f}.")
+
+    # The source lines around the missing ones give the context
+    first, last = missing[0]['id'], missing[-1]['id']
+    before = ((context_before or []) + texts[:first])[-context_lines:]
+    after = (texts[last + 1:] + (context_after or []))[:context_lines]
+
+  else:
+    raise Exception(f"Could not translate {len(texts) - len(translations)} lines after {max_attempts} attempts.")
+
+  # Remember the result for the next runs
+  translated_texts = [translations[line['id']] for line in lines]
+  put_cached_result(cache_key, translated_texts)
+
+  # Return list of translated texts
+  return translated_texts
+
+
+
+def translate(client: genai.Client, subtitles, target: str = "en"):
+  # Translate the text of every subtitle
+  track = as_subtitle_track(subtitles)
+  translated_texts = translate_lines(client, track.texts.tolist(), target = target)
+
+  # Same times, translated texts
+  return track.with_texts(translated_texts)
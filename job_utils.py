@@ -0,0 +1,123 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import os
+import json
+import shutil
+import threading
+from pathlib import Path
+
+
+
+# Written into every work directory created by a job, nothing else is ever deleted
+marker_name = ".geminisub-job"
+
+
+
+def get_default_job_dir(video_path: Path):
+  # Hidden directory next to the video, so that a rerun finds it again
+  return video_path.with_name(f".{video_path.stem}.geminisub")
+
+
+
+class JobManifest:
+  """Checkpoint of a job: outputs of each stage and status of each chunk, saved atomically after every change."""
+
+  def __init__(self, job_dir: Path, resume: bool = False):
+    self.job_dir = job_dir
+    self.path = job_dir / "manifest.json"
+    self.lock = threading.Lock()
+
+    # Start from the last checkpoint, or from a clean directory
+    if resume and self.path.exists():
+      self.data = json.loads(self.path.read_text(encoding = "utf-8"))
+      print(f"Resuming job from {job_dir}.")
+    else:
+      # Only a directory left by a previous job is cleared, a directory holding anything else is refused
+      if self.is_owned():
+        shutil.rmtree(job_dir)
+      elif job_dir.exists() and any(job_dir.iterdir()):
+        raise FileExistsError(f"{job_dir} already holds files that are not from a job, refusing to use it as a work directory.")
+      job_dir.mkdir(parents = True, exist_ok = True)
+      (job_dir / marker_name).touch()
+      self.data = {
+        'stages': {},
+        'chunks': []
+      }
+      self._save()
+
+
+  def __getstate__(self):
+    # The manifest is handed over by the process that prepared the job, without its lock
+    state = self.__dict__.copy()
+    del state['lock']
+    return state
+
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
+
+  def get(self, stage: str, default = None):
+    with self.lock:
+      return self.data['stages'].get(stage, default)
+
+
+  def set(self, stage: str, value):
+    with self.lock:
+      self.data['stages'][stage] = value
+      self._save()
+
+
+  def get_path(self, stage: str):
+    # Paths are stored relative to the job directory, and only valid while the file is there
+    name = self.get(stage)
+    if name is None or not (self.job_dir / name).exists():
+      return None
+    return self.job_dir / name
+
+
+  def set_path(self, stage: str, path: Path):
+    self.set(stage, str(path.relative_to(self.job_dir)))
+
+
+  def get_chunks(self):
+    with self.lock:
+      return [dict(chunk) for chunk in self.data['chunks']]
+
+
+  def set_chunks(self, chunks):
+    with self.lock:
+      self.data['chunks'] = [dict(chunk) for chunk in chunks]
+      self._save()
+
+
+  def update_chunk(self, index: int, **fields):
+    with self.lock:
+      self.data['chunks'][index].update(fields)
+      self._save()
+
+
+  def reset(self, *stages: str):
+    # Forget stages whose inputs changed, and every chunk built from them
+    with self.lock:
+      for stage in stages:
+        self.data['stages'].pop(stage, None)
+      self.data['chunks'] = []
+      self._save()
+
+
+  def is_owned(self):
+    # Created by a job, or by an earlier version that only wrote the manifest
+    return (self.job_dir / marker_name).exists() or self.path.exists()
+
+
+  def remove(self):
+    if self.is_owned():
+      shutil.rmtree(self.job_dir, ignore_errors = True)
+
+
+  def _save(self):
+    # Write aside then rename, so that a crash never leaves a truncated manifest
+    temporary_path = self.path.with_suffix(".tmp")
+    temporary_path.write_text(json.dumps(self.data, ensure_ascii = False, indent = 2), encoding = "utf-8")
+    os.replace(temporary_path, self.path)
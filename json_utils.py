@@ -0,0 +1,56 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import json
+
+
+
+class TruncatedArray(list):
+  """Complete items of a JSON array whose end never arrived."""
+  pass
+
+
+
+class IncrementalArrayParser:
+  """Parse the items of the array stored under a key of a JSON object, as the text arrives."""
+
+  def __init__(self, key: str):
+    self.key = key
+    self.decoder = json.JSONDecoder()
+    self.buffer = ""
+    self.position = None
+    self.items = []
+    self.complete = False
+
+
+  def feed(self, text: str):
+    """Add the next piece of text, returns the items completed by it."""
+    self.buffer += text
+    new_items = []
+
+    # Find the opening bracket of the array
+    if self.position is None:
+      key_position = self.buffer.find(f'"{self.key}"')
+      if key_position < 0:
+        return new_items
+      bracket_position = self.buffer.find("[", key_position)
+      if bracket_position < 0:
+        return new_items
+      self.position = bracket_position + 1
+
+    # Decode every item that is complete
+    while not self.complete:
+      while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n,":
+        self.position += 1
+      if self.position >= len(self.buffer):
+        break
+      if self.buffer[self.position] == "]":
+        self.complete = True
+        break
+      try:
+        item, end = self.decoder.raw_decode(self.buffer, self.position)
+      except json.JSONDecodeError:
+        break
+      self.items.append(item)
+      new_items.append(item)
+      self.position = end
+
+    return new_items
@@ -1,125 +1,112 @@
 # Written by Chiw the Neko <chiwtheneko@gmail.com>
 import os
-import time
+import sys
 import argparse
-import tempfile
-import logging
-from pathlib import Path
-from ffmpeg_utils import extract_all_audio, extract_audio_as_video, get_file_duration, FFmpegError
-from gemini_utils import display_available_models, transcribe, translate
-from vad_utils import find_speech_timestamps, find_optimal_split_points
-from srt_utils import merge_srt, write_srt_file
-from exception_utils import get_fqn
+from cache_utils import get_default_cache_path
 
 
 
-def main():
+def create_parser():
   # Setup the argument parser
   parser = argparse.ArgumentParser(description = "Extract audio from a video file.")
 
   # Define arguments
-  parser.add_argument("input", type = str, nargs = '?', help = "Path to the source video file")
+  parser.add_argument("input", type = str, nargs = '*', help = "Paths to the source video files, directories or glob patterns")
   parser.add_argument("--list-models", action = "store_true", help = "Display all available Gemini models and exit")
+  parser.add_argument("--workers", type = int, default = 4, help = "Number of chunks sent to Gemini concurrently by each stage")
+  parser.add_argument("--full-vad", action = "store_true", help = "Load the whole audio in memory for VAD instead of streaming it")
+  parser.add_argument("--vad-workers", type = int, default = 1, help = "Number of processes running VAD over shards of the audio, for each of the --prepare-workers and capped to its share of the cores")
+  parser.add_argument("--prepare-workers", type = int, default = 2, help = "Number of videos whose audio is extracted and split ahead of the API work")
+  parser.add_argument("--split-mode", choices = ["greedy", "balanced"], default = "greedy", help = "Pick split points window by window, or balance all chunks at once")
+  parser.add_argument("--max-duration", type = float, default = 600, help = "Maximum duration of a chunk in seconds")
+  parser.add_argument("--chunk-tokens", type = int, default = 1500, help = "Expected transcription tokens of a chunk, estimated from its speech, 0 to only cut by --max-duration")
+  parser.add_argument("--chunk-concurrency", type = int, default = 4, help = "Minimum number of chunks to cut a video into when it has enough speech, so that workers run side by side")
+  parser.add_argument("--elide-silence", action = "store_true", help = "Only upload the speech found by VAD, the subtitle times are mapped back to the video")
+  parser.add_argument("--speech-padding", type = float, default = 0.3, help = "Seconds of audio kept around each speech segment when silences are elided")
+  parser.add_argument("--segmenter", choices = ["single", "per-chunk"], default = "single", help = "Cut all chunks in one ffmpeg pass, or one ffmpeg process per chunk")
+  parser.add_argument("--upload-format", choices = ["mp4", "mp3", "opus", "flac"], default = "mp4", help = "Container and codec of the uploaded chunks, mp4 wraps the audio with a black video track")
+  parser.add_argument("--bitrate", type = str, help = "Audio bitrate of the uploaded chunks, e.g. 24k")
+  parser.add_argument("--inline-size", type = float, default = 4, help = "Chunks up to this size in MB are sent inside the request instead of uploaded")
+  parser.add_argument("--stream", action = "store_true", help = "Stream the replies, writing the transcribed lines as they arrive and keeping what arrived when one is cut short")
+  parser.add_argument("--translation-budget", type = int, default = 4000, help = "Target input tokens of each translation request")
+  parser.add_argument("--targets", type = str, default = "en", help = "Comma separated codes of the languages to translate to, e.g. en,fr,de")
+  parser.add_argument("--subtitle-format", choices = ["srt", "vtt", "ass"], default = "srt", help = "Format of the subtitle files, written chunk by chunk")
+  parser.add_argument("--context-lines", type = int, default = 3, help = "Lines of the neighboring batches sent as read-only context")
+  parser.add_argument("--no-cache", action = "store_true", help = "Do not reuse nor store transcription and translation results")
+  parser.add_argument("--cache-path", type = str, default = str(get_default_cache_path()), help = "Path of the result cache database")
+  parser.add_argument("--cache-size", type = int, default = 512, help = "Maximum size of the result cache in MB")
+  parser.add_argument("--job-dir", type = str, help = "Directory holding the work directory of each video, next to the video by default")
+  parser.add_argument("--resume", action = "store_true", help = "Continue the job from its last completed step")
+  parser.add_argument("--keep-job", action = "store_true", help = "Keep the work directory once the job is done")
+  parser.add_argument("--pool-size", type = int, help = "Number of HTTP connections kept open to Gemini")
+  parser.add_argument("--rpm", type = int, help = "Requests per minute allowed for the model")
+  parser.add_argument("--tpm", type = int, help = "Tokens per minute allowed for the model")
+  parser.add_argument("--batch", action = "store_true", help = "Send all requests of all videos as batch jobs, slower but cheaper")
+  parser.add_argument("--batch-poll-interval", type = float, default = 30, help = "Seconds before checking a batch job for the first time, doubled after each check")
+  parser.add_argument("--base-url", type = str, help = "Address of the Gemini API, e.g. a local stand-in server")
+  parser.add_argument("--metrics-report", type = str, help = "Path of a JSON report with the spans, counters and timings of the run")
+  parser.add_argument("--metrics-textfile", type = str, help = "Path of a Prometheus textfile with the counters and timings of the run")
+  parser.add_argument("--serve", action = "store_true", help = "Stay resident with the client and the VAD models loaded, running the jobs submitted with --server")
+  parser.add_argument("--listen", type = str, default = "127.0.0.1:8765", help = "Address the resident process listens on")
+  parser.add_argument("--server", type = str, help = "Address of a resident process to run the job, e.g. http://127.0.0.1:8765")
+  return parser
+
+
+
+def parse_args(parser: argparse.ArgumentParser, argv = None):
+  args = parser.parse_args(argv)
+  args.targets = list(dict.fromkeys(target.strip() for target in args.targets.split(",") if target.strip()))
+  if not args.targets:
+    parser.error("--targets needs at least one language")
+  return args
+
+
+
+def without_server_argument(argv):
+  # The command line given to the resident process, which must not submit it again
+  kept = []
+  skip = False
+  for argument in argv:
+    if skip:
+      skip = False
+    elif argument == "--server":
+      skip = True
+    elif not argument.startswith("--server="):
+      kept.append(argument)
+  return kept
+
 
-  # Parse args
-  args = parser.parse_args()
 
-  # Retrieve the key
-  api_key = os.environ.get("GEMINI_API_KEY")
-  if not api_key:
-    raise ValueError("GEMINI_API_KEY not found in environment variables!")
+def main():
+  # Only light modules are imported until we know what to do, torch and google-genai take seconds
+  parser = create_parser()
+  args = parse_args(parser)
+
+  # Resident process, warmed up once for every job
+  if args.serve:
+    from serve_utils import serve
+    serve(args, lambda argv: parse_args(parser, argv))
+    return
 
-  # Display models and exit if --list-models was given on the command line
-  if args.list_models:
-    display_available_models(api_key)
+  if not args.input and not args.list_models:
+    parser.print_help()
     return
 
-  # Convert the input string into a Path object
-  video_path = Path(args.input)
+  # Listing the models only needs the API client, not torch nor ffmpeg
+  if args.list_models and not args.server:
+    from gemini_utils import get_client, display_available_models
+    display_available_models(get_client(os.environ.get("GEMINI_API_KEY"), base_url = args.base_url))
+    return
 
-  # Make sure the file exist
-  if not video_path.exists():
-    print(f"Error: The file '{video_path}' was not found.")
+  # Thin client of a resident process
+  if args.server:
+    from serve_utils import submit_job
+    submit_job(args.server, without_server_argument(sys.argv[1:]))
     return
 
-  print(f"Processing: {video_path.name}...")
-
-  # Temporary work directory
-  with tempfile.TemporaryDirectory() as tmp_dir_name:
-    working_dir = Path(tmp_dir_name)
-
-    try:
-      # Extract all the audio in the video file
-      print("Extracting audio...")
-      audio_path = extract_all_audio(video_path, working_dir)
-
-      # Total audio duration
-      duration = get_file_duration(audio_path)
-      print(f"Audio duration: {duration}")
-
-      # Find speech gaps
-      print("Finding speech gaps...")
-      speech_timestamps = find_speech_timestamps(audio_path)
-
-      # Find split points
-      print("Finding optimal split points...")
-      splits = find_optimal_split_points(speech_timestamps, duration, 120)
-      splits.append(duration)
-
-      # Split into chunks
-      chunks = []
-      start = 0
-      for split in splits:
-        chunk = extract_audio_as_video(audio_path, start, split, working_dir)
-        chunks.append({
-          'start': start,
-          'audio': chunk
-        })
-        start = split
-
-      # Transcribe audio chunks
-      transcriptions = []
-      for chunk in chunks:
-        subtitles = transcribe(chunk['audio'], api_key)
-        print("-------------------------------------------")
-        print(subtitles)
-        transcriptions.append({
-          'start': chunk['start'],
-          'data' : subtitles
-        })
-        time.sleep(30)  # Be polite
-
-      # Translated transcriptions
-      translations = []
-      for transcription in transcriptions:
-        subtitles = translate(transcription['data'], api_key)
-        print("-------------------------------------------")
-        print(subtitles)
-        translations.append({
-          'start': transcription['start'],
-          'data' : subtitles
-        })
-        time.sleep(30)  # Be polite
-
-      # Parse and merge transcriptions
-      transcribed_subtitles = merge_srt(transcriptions)
-
-      # Save transcribed subtitle
-      write_srt_file(video_path, "jp", transcribed_subtitles)
-
-      # Parse and merge translations
-      translated_subtitles = merge_srt(translations)
-
-      # Save translated subtitle
-      write_srt_file(video_path, "en", translated_subtitles)
-
-    except FFmpegError as err:
-      # This specifically catches our FFmpeg errors
-      print(f"An error occurred during processing: {err}")
-
-    except Exception as e:
-      # This catches other issues (like file permissions or missing ffmpeg)
-      logging.exception(f"A general error occurred. {get_fqn(e)}")
+  from processing_utils import run
+  run(args)
+
 
 
 
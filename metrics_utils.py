@@ -0,0 +1,197 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import os
+import json
+import time
+import threading
+import itertools
+import contextlib
+from pathlib import Path
+from datetime import datetime, timezone
+
+
+
+class Metrics:
+  """Counters, summaries of observed values and timed spans shared by every thread, dumped as a JSON report or a Prometheus textfile."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.ids = itertools.count(1)
+    self.started = time.time()
+    self.counters = {}
+    self.summaries = {}
+    self.spans = []
+
+
+  def reset(self):
+    """Forget everything, e.g. before the next job of a resident process."""
+    with self.lock:
+      self.started = time.time()
+      self.counters = {}
+      self.summaries = {}
+      self.spans = []
+
+
+  def count(self, name: str, value: float = 1, **labels):
+    """Add value to a counter."""
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+
+  def observe(self, name: str, value: float, **labels):
+    """Add a value to a summary, e.g. a duration or a size."""
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      summary = self.summaries.get(key)
+      if summary is None:
+        summary = self.summaries[key] = {'count': 0, 'sum': 0.0, 'max': value}
+      summary['count'] += 1
+      summary['sum'] += value
+      summary['max'] = max(summary['max'], value)
+
+
+  @contextlib.contextmanager
+  def span(self, name: str, **labels):
+    """Time the enclosed block, spans opened inside it by the same thread are its children."""
+    # Ids stay unique when the spans of worker processes are merged
+    span_id = f"{os.getpid()}-{next(self.ids)}"
+    stack = self.local.__dict__.setdefault('stack', [])
+    record = {
+      'id'    : span_id,
+      'parent': stack[-1] if stack else None,
+      'name'  : name,
+      'labels': labels,
+      'thread': threading.current_thread().name,
+      'start' : time.time(),
+      'error' : None
+    }
+    stack.append(span_id)
+    start_time = time.perf_counter()
+    try:
+      yield record
+    except BaseException as e:
+      record['error'] = type(e).__name__
+      raise
+    finally:
+      stack.pop()
+      record['duration'] = time.perf_counter() - start_time
+      with self.lock:
+        self.spans.append(record)
+      self.observe("span_seconds", record['duration'], span = name)
+
+
+  def drain(self):
+    """Take everything recorded so far, e.g. to send it from a worker process to the main one."""
+    with self.lock:
+      snapshot = {'counters': self.counters, 'summaries': self.summaries, 'spans': self.spans}
+      self.counters = {}
+      self.summaries = {}
+      self.spans = []
+    return snapshot
+
+
+  def merge(self, snapshot):
+    """Add what drain() returned in another process."""
+    with self.lock:
+      for key, value in snapshot['counters'].items():
+        self.counters[key] = self.counters.get(key, 0) + value
+      for key, other in snapshot['summaries'].items():
+        summary = self.summaries.get(key)
+        if summary is None:
+          self.summaries[key] = dict(other)
+          continue
+        summary['count'] += other['count']
+        summary['sum'] += other['sum']
+        summary['max'] = max(summary['max'], other['max'])
+      self.spans.extend(snapshot['spans'])
+
+
+  def report(self, **extra):
+    """Everything as a dict ready for JSON, span start times are in seconds since the run started."""
+    with self.lock:
+      counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+      summaries = [{'name': name, 'labels': dict(labels), **summary} for (name, labels), summary in sorted(self.summaries.items())]
+      spans = [dict(span, start = span['start'] - self.started) for span in sorted(self.spans, key = lambda span: span['start'])]
+    return {
+      'started'  : datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+      'duration' : time.time() - self.started,
+      'counters' : counters,
+      'summaries': summaries,
+      'spans'    : spans,
+      **extra
+    }
+
+
+  def write_report(self, path: Path, **extra):
+    write_atomically(path, json.dumps(self.report(**extra), ensure_ascii = False, indent = 2))
+
+
+  def write_prometheus(self, path: Path, prefix: str = "geminisub"):
+    """Textfile for the node exporter, counters get the _total suffix and summaries their _count, _sum and _max series."""
+    lines = []
+    with self.lock:
+      counters = sorted(self.counters.items())
+      summaries = sorted(self.summaries.items())
+
+    declared = set()
+    for (name, labels), value in counters:
+      metric = f"{prefix}_{name}_total"
+      if metric not in declared:
+        declared.add(metric)
+        lines.append(f"# TYPE {metric} counter")
+      lines.append(f"{metric}{format_labels(labels)} {value}")
+
+    # The series of a family must follow each other, so the maxima come after all the counts and sums
+    for name in dict.fromkeys(name for (name, _), _ in summaries):
+      metric = f"{prefix}_{name}"
+      series = [(labels, summary) for (summary_name, labels), summary in summaries if summary_name == name]
+      lines.append(f"# TYPE {metric} summary")
+      for labels, summary in series:
+        lines.append(f"{metric}_count{format_labels(labels)} {summary['count']}")
+        lines.append(f"{metric}_sum{format_labels(labels)} {summary['sum']}")
+      lines.append(f"# TYPE {metric}_max gauge")
+      for labels, summary in series:
+        lines.append(f"{metric}_max{format_labels(labels)} {summary['max']}")
+
+    lines.append(f"# TYPE {prefix}_run_duration_seconds gauge")
+    lines.append(f"{prefix}_run_duration_seconds {time.time() - self.started}")
+    write_atomically(path, "\n".join(lines) + "\n")
+
+
+
+def format_labels(labels):
+  if not labels:
+    return ""
+  escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+  return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(labels, escaped)) + "}"
+
+
+
+def read_peak_rss(pid = "self", name: str = None):
+  """High water mark of the resident memory of a process in bytes, None when it cannot be read, e.g. once it exited or without /proc."""
+  # ru_maxrss also counts the memory of the parent a process was forked from, before it started its own program
+  # With a name, only once the process runs that program
+  try:
+    with open(f"/proc/{pid}/status") as status:
+      fields = dict(line.split(":", 1) for line in status if ":" in line)
+  except OSError:
+    return None
+  if name is not None and fields.get('Name', "").strip() != name[:15]:
+    return None
+  if 'VmHWM' not in fields:
+    return None
+  return int(fields['VmHWM'].split()[0]) * 1024
+
+
+
+def write_atomically(path: Path, text: str):
+  # The node exporter must never read a half written file
+  temporary_path = path.with_name(f".{path.name}.tmp")
+  temporary_path.write_text(text, encoding = "utf-8")
+  os.replace(temporary_path, path)
+
+
+
+# Shared by every module, each process has its own
+metrics = Metrics()
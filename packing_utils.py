@@ -0,0 +1,128 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+from gemini_utils import estimate_text_tokens
+
+
+
+class LinePacker:
+  """Regroups the transcribed lines of consecutive chunks into translation batches of a target token budget."""
+
+  def __init__(self, token_budget: int, context_lines: int = 3, nb_chunks: int = None, targets = ("en",)):
+    self.token_budget = token_budget
+    self.context_lines = context_lines
+    self.nb_chunks = nb_chunks
+    self.targets = list(targets)
+    self.next_index = 0
+    self.waiting = {}
+    self.pending = []
+    self.pending_tokens = 0
+    self.context_before = []
+
+
+  def add(self, chunk):
+    """Take a transcribed chunk, returns the batches and chunks ready to go downstream."""
+    # Lines are packed in chunk order, whatever order the chunks were transcribed in
+    self.waiting[chunk['index']] = chunk
+    ready = []
+    while self.next_index in self.waiting:
+      chunk = self.waiting.pop(self.next_index)
+      self.next_index += 1
+
+      # Nothing to translate in this chunk
+      translations = chunk.setdefault('translations', {})
+      if not chunk['transcription']:
+        for target in self.targets:
+          translations.setdefault(target, [])
+      missing_targets = [target for target in self.targets if target not in translations]
+      if not missing_targets:
+        ready.append(chunk)
+        continue
+
+      # Lines are translated separately then put back in place, for every missing language
+      chunk['translated_texts'] = {target: [None] * len(chunk['transcription']) for target in missing_targets}
+      chunk['pending_lines'] = len(chunk['transcription']) * len(missing_targets)
+      for i, subtitle in enumerate(chunk['transcription']):
+        tokens = estimate_text_tokens(subtitle['text'])
+        self.pending.append((chunk, i, tokens))
+        self.pending_tokens += tokens
+
+    # Send full batches once the lines following them are known, to give them as context
+    while self.pending_tokens >= self.token_budget:
+      size = self._batch_size()
+      if len(self.pending) - size < self.context_lines:
+        break
+      ready.extend(self._make_batches(size))
+
+    # Once the last chunk is in, nothing is left to wait for
+    if self.nb_chunks is not None and self.next_index == self.nb_chunks:
+      ready.extend(self.flush())
+    return ready
+
+
+  def flush(self):
+    """Returns the batches of the remaining lines."""
+    ready = []
+    while self.pending:
+      ready.extend(self._make_batches(self._batch_size()))
+    return ready
+
+
+  def _batch_size(self):
+    # As many lines as fit in the budget, at least one
+    size = 0
+    tokens = 0
+    for _, _, line_tokens in self.pending:
+      if size > 0 and tokens + line_tokens > self.token_budget:
+        break
+      tokens += line_tokens
+      size += 1
+    return size
+
+
+  def _make_batches(self, size: int):
+    lines = self.pending[:size]
+    self.pending = self.pending[size:]
+    self.pending_tokens -= sum(tokens for _, _, tokens in lines)
+    batch = {
+      'lines'         : [(chunk, i) for chunk, i, _ in lines],
+      'texts'         : [chunk['transcription'][i]['text'] for chunk, i, _ in lines],
+      'context_before': self.context_before,
+      'context_after' : [chunk['transcription'][i]['text'] for chunk, i, _ in self.pending[:self.context_lines]]
+    }
+    self.context_before = batch['texts'][-self.context_lines:] if self.context_lines > 0 else []
+
+    # The same lines go to every language one of their chunks still misses
+    targets = [target for target in self.targets if any(target in chunk['translated_texts'] for chunk, _, _ in lines)]
+    return [dict(batch, target = target) for target in targets]
+
+
+
+def assemble_translations(item):
+  """Put the translated lines of a batch back into their chunks, returns the chunks now fully translated."""
+  # Chunks that did not need translating go straight through
+  if 'lines' not in item:
+    return [item]
+
+  completed = []
+  target = item['target']
+  for (chunk, i), text in zip(item['lines'], item['translations']):
+    # Chunks that already had this language share the batch with chunks that did not
+    if target not in chunk['translated_texts']:
+      continue
+    chunk['translated_texts'][target][i] = text
+    chunk['pending_lines'] -= 1
+    if chunk['pending_lines'] > 0:
+      continue
+
+    # Recreate subtitles from the translated lines, for every language
+    for target_language, translated_texts in chunk.pop('translated_texts').items():
+      chunk['translations'][target_language] = []
+      for subtitle, translated_text in zip(chunk['transcription'], translated_texts):
+        chunk['translations'][target_language].append({
+          'index': subtitle['index'],
+          'start': subtitle['start'],
+          'end'  : subtitle['end'],
+          'text' : translated_text,
+        })
+    del chunk['pending_lines']
+    completed.append(chunk)
+  return completed
@@ -1,15 +1,20 @@
 # Written by Chiw the Neko <chiwtheneko@gmail.com>
 import re
+import glob
 import uuid
 from pathlib import Path
 
 
 
-def generate_unique_path(video_path: Path, suffix: str):
+# Files picked up when a directory is given
+video_extensions = {".mp4", ".mkv", ".avi", ".mov", ".webm", ".m4v", ".ts", ".flv", ".wmv", ".mpg", ".mpeg"}
+
+
+
+def generate_unique_path(video_path: Path, suffix: str, extension: str = ".srt"):
   # Define the pattern to look for
   # This matches: filename.jp.srt AND filename.jp(ANY_NUMBER).srt
   base_stem = f"{video_path.stem}.{suffix}"
-  extension = ".srt"
 
   # Get all existing files in the directory that start with our base name
   # We use glob to find only relevant files
@@ -51,3 +56,25 @@ def generate_temporary_path(working_dir: Path, extension: str):
   unique_filename = f"{uuid.uuid4()}.{extension}"
   unique_path = working_dir / unique_filename
   return unique_path
+
+
+
+def expand_input_paths(inputs):
+  # Files are taken as they are, directories give their videos and patterns give their matches, all in order
+  video_paths = []
+  for input_path in inputs:
+    path = Path(input_path)
+    if path.is_dir():
+      candidates = sorted(p for p in path.iterdir() if p.suffix.lower() in video_extensions)
+    elif path.exists():
+      candidates = [path]
+    else:
+      candidates = sorted(Path(p) for p in glob.glob(input_path, recursive = True) if Path(p).is_file())
+      if not candidates:
+        print(f"Warning: Nothing matches '{input_path}'.")
+
+    # The same video given twice is only processed once
+    for candidate in candidates:
+      if candidate.resolve() not in (p.resolve() for p in video_paths):
+        video_paths.append(candidate)
+  return video_paths
@@ -0,0 +1,139 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import queue
+import threading
+from metrics_utils import metrics
+
+
+
+# Marks the end of the stream of items
+_end_of_stream = object()
+
+
+
+class Pipeline:
+  """Chain of stages connected by bounded queues, each stage running in its own pool of threads."""
+
+  def __init__(self, queue_size: int = 2, describe = None):
+    # describe gives the labels of the span of an item in each stage, e.g. its chunk
+    self.queue_size = queue_size
+    self.describe = describe
+    self.stages = []
+    self.error = None
+    self.abort = threading.Event()
+
+
+  def add_stage(self, name: str, function, workers: int = 1, fan_out: bool = False, flush = None):
+    # The function receives an item and returns it once processed
+    # With fan_out it returns a list of items instead, possibly empty, and flush returns the items still held at the end
+    self.stages.append({
+      'name'    : name,
+      'function': function,
+      'workers' : max(1, workers),
+      'fan_out' : fan_out,
+      'flush'   : flush
+    })
+
+
+  def run(self, items):
+    # One queue in front of each stage, plus the output queue
+    queues = [queue.Queue(maxsize = self.queue_size) for _ in range(len(self.stages) + 1)]
+
+    # Start the workers of every stage
+    threads = [threading.Thread(target = self._feed, args = (items, queues[0]), daemon = True)]
+    for i, stage in enumerate(self.stages):
+      remaining = [stage['workers']]
+      lock = threading.Lock()
+      for _ in range(stage['workers']):
+        threads.append(threading.Thread(
+          target = self._work,
+          args = (stage, queues[i], queues[i + 1], remaining, lock),
+          name = stage['name'],
+          daemon = True
+        ))
+    for thread in threads:
+      thread.start()
+
+    # Drain the last queue
+    results = []
+    while True:
+      item = self._get(queues[-1])
+      if item is None or item is _end_of_stream:
+        break
+      results.append(item)
+
+    for thread in threads:
+      thread.join()
+
+    if self.error is not None:
+      raise self.error
+
+    return results
+
+
+  def _fail(self, error: Exception):
+    if self.error is None:
+      self.error = error
+    self.abort.set()
+
+
+  def _put(self, target: queue.Queue, item):
+    # Block while the next stage is busy, unless the pipeline is aborted
+    while not self.abort.is_set():
+      try:
+        target.put(item, timeout = 0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+
+  def _get(self, source: queue.Queue):
+    while not self.abort.is_set():
+      try:
+        return source.get(timeout = 0.1)
+      except queue.Empty:
+        pass
+    return None
+
+
+  def _feed(self, items, target: queue.Queue):
+    try:
+      for item in items:
+        if not self._put(target, item):
+          return
+      self._put(target, _end_of_stream)
+    except Exception as e:
+      self._fail(e)
+
+
+  def _work(self, stage, source: queue.Queue, target: queue.Queue, remaining, lock: threading.Lock):
+    try:
+      while True:
+        item = self._get(source)
+        if item is None:
+          return
+
+        # Let the sibling workers see the end of stream too, the last one forwards it
+        if item is _end_of_stream:
+          self._put(source, _end_of_stream)
+          with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+          if last:
+            if stage['flush'] is not None:
+              for output in stage['flush']():
+                self._put(target, output)
+            self._put(target, _end_of_stream)
+          return
+
+        labels = self.describe(item) if self.describe is not None else {}
+        with metrics.span(stage['name'], **labels):
+          outputs = stage['function'](item)
+        if not stage['fan_out']:
+          outputs = [outputs]
+        for output in outputs:
+          if not self._put(target, output):
+            return
+    except Exception as e:
+      print(f"Stage '{stage['name']}' failed.")
+      self._fail(e)
@@ -0,0 +1,681 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import os
+import time
+import logging
+import itertools
+import multiprocessing
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from google import genai
+from google.genai import types
+from ffmpeg_utils import extract_all_audio, extract_chunk, extract_chunks, FFmpegError
+from gemini_utils import get_client, display_available_models, configure_rate_limits, set_result_cache, get_cached_result, put_cached_result, get_transcription_request, get_transcription_cache_key, transcribe_file
+from gemini_utils import get_translation_config, get_translation_content, get_translation_cache_key, align_translations, translate_lines, record_translation_stat, translation_stats, reset_translation_stats
+from batch_utils import make_batch_request, run_batch, resume_batch
+from json_utils import TruncatedArray
+from vad_utils import find_speech_timestamps, find_optimal_split_points, init_vad_process, get_chunk_speech_budget, output_tokens_per_speech_second
+from srt_utils import merge_srt, write_srt_file, SubtitleWriter
+from path_utils import expand_input_paths, generate_temporary_path
+from exception_utils import get_fqn
+from pipeline_utils import Pipeline
+from audio_utils import PcmAudio
+from cache_utils import ResultCache
+from job_utils import JobManifest, get_default_job_dir
+from packing_utils import LinePacker, assemble_translations
+from upload_utils import UploadStore
+from metrics_utils import metrics, read_peak_rss
+from elision_utils import OffsetMap, get_speech_regions, write_speech_audio, restore_subtitle_times
+
+
+
+def process_videos(videos, client: genai.Client, args):
+  # Chunks of every video go through the same stages, so the API is kept busy while the next videos are prepared
+  uploads = UploadStore(client, int(args.inline_size * 1024 * 1024))
+
+  # Feed the chunks of each video as soon as it is prepared
+  def feed():
+    for video in videos:
+      if video['status'] != "prepared":
+        continue
+      video['status'] = "processing"
+      video['queued'] = time.perf_counter()
+      video['remaining_chunks'] = len(video['chunks'])
+
+      # Tracks are written chunk by chunk, a player can open them before the video is done
+      video['writers'] = {suffix: SubtitleWriter(video['video_path'], suffix, args.subtitle_format) for suffix in ["jp"] + args.targets}
+      for chunk in video['chunks']:
+        chunk['video'] = video
+        yield chunk
+
+  # Cut the chunk out of the audio
+  def cut(chunk):
+    if chunk.get('audio') is None:
+      cut_chunk(chunk['video'], chunk, args)
+    return chunk
+
+  # Send the chunk to the Media API, unless it was already transcribed in a previous run
+  def send(chunk):
+    if chunk.get('transcription') is not None:
+      return chunk
+    manifest = chunk['video']['manifest']
+    chunk['cache_key'] = get_transcription_cache_key(chunk['audio'])
+    cached = get_cached_result(chunk['cache_key'])
+    if cached is not None:
+      print(f"Using cached transcription for chunk {chunk['index']}.")
+      chunk['transcription'] = restore_subtitle_times(cached, get_offset_map(chunk))
+      manifest.update_chunk(chunk['index'], transcription = chunk['transcription'], status = "transcribed")
+      return chunk
+
+    # Start the upload, the server processes the file while the next chunks are sent
+    chunk['upload'] = uploads.start(chunk['audio'], chunk.get('file_name'))
+    if 'file' in chunk['upload']:
+      manifest.update_chunk(chunk['index'], file_name = chunk['upload']['file'].name, status = "uploaded")
+    return chunk
+
+  # Wait for the server to be done processing the file
+  def wait_for_upload(chunk):
+    if 'upload' in chunk:
+      chunk['file'] = uploads.wait(chunk['upload'])
+    return chunk
+
+  # Transcribe the uploaded chunk then delete it from the server
+  # The transcription track does not wait for the translations, a streamed reply is written to it as it arrives
+  def transcribe_chunk(chunk):
+    writer = chunk['video']['writers']["jp"]
+    if chunk.get('transcription') is None:
+      def on_subtitle(subtitle):
+        print(f"[chunk {chunk['index']}] {subtitle['text']}")
+        writer.add_partial(chunk['index'], chunk['start'], restore_subtitle_times([subtitle], get_offset_map(chunk)))
+
+      try:
+        subtitles = transcribe_file(client, chunk['file'], get_audio_duration(chunk), chunk['cache_key'], args.stream, on_subtitle if args.stream else None)
+        chunk['transcription'] = restore_subtitle_times(subtitles, get_offset_map(chunk))
+      finally:
+        uploads.release(chunk.pop('upload'))
+      chunk['video']['manifest'].update_chunk(chunk['index'], file_name = None, transcription = chunk['transcription'], status = "transcribed")
+      print("-------------------------------------------")
+      print(chunk['transcription'])
+    writer.add(chunk['index'], chunk['start'], chunk['transcription'])
+    return chunk
+
+  # Regroup the lines of consecutive chunks of a video into batches sized for the translation requests
+  packers = {}
+
+  def pack(chunk):
+    video = chunk['video']
+    if video['index'] not in packers:
+      packers[video['index']] = LinePacker(args.translation_budget, args.context_lines, len(video['chunks']), args.targets)
+    return packers[video['index']].add(chunk)
+
+  def flush():
+    return [item for packer in packers.values() for item in packer.flush()]
+
+  # Translate a batch of lines into one language
+  def translate_batch(item):
+    if 'lines' in item:
+      item['translations'] = translate_lines(client, item['texts'], item['context_before'], item['context_after'], context_lines = args.context_lines, stream = args.stream, target = item['target'])
+    return item
+
+  # Put the translated lines back into their chunks, and append the finished chunks to the subtitle files
+  def assemble(item):
+    completed = assemble_translations(item)
+    for chunk in completed:
+      video = chunk['video']
+      if 'lines' in item or chunk.get('status') != "translated":
+        chunk['status'] = "translated"
+        video['manifest'].update_chunk(chunk['index'], translations = chunk['translations'], status = "translated")
+        print("-------------------------------------------")
+        print(chunk['translations'])
+      for target in args.targets:
+        video['writers'][target].add(chunk['index'], chunk['start'], chunk['translations'][target])
+      video['remaining_chunks'] -= 1
+      if video['remaining_chunks'] == 0:
+        for writer in video.pop('writers').values():
+          writer.close()
+        if not args.keep_job:
+          video['manifest'].remove()
+        video['done'] = time.perf_counter()
+        video['status'] = "done"
+    return completed
+
+  # Spans of every stage are labeled with their chunk, a batch of lines with its first chunk
+  def describe(item):
+    chunk = item['lines'][0][0] if 'lines' in item else item
+    labels = {'video': chunk['video']['video_path'].name, 'chunk': chunk['index']}
+    if 'target' in item:
+      labels['target'] = item['target']
+    return labels
+
+  # Chunk N is translated while chunk N+1 is transcribed and chunk N+2 is cut, uploaded and processed
+  # Every language is translated side by side, under the same rate limit
+  pipeline = Pipeline(queue_size = args.workers, describe = describe)
+  pipeline.add_stage("cut", cut, workers = 2)
+  pipeline.add_stage("upload", send, workers = 2)
+  pipeline.add_stage("process", wait_for_upload, workers = args.workers)
+  pipeline.add_stage("transcribe", transcribe_chunk, workers = args.workers)
+  pipeline.add_stage("pack", pack, fan_out = True, flush = flush)
+  pipeline.add_stage("translate", translate_batch, workers = args.workers * len(args.targets))
+  pipeline.add_stage("assemble", assemble, fan_out = True)
+  pipeline.run(feed())
+
+
+
+def cut_chunk(video, chunk, args):
+  # Cut the audio of the chunk, or only its speech when silences are elided
+  manifest = video['manifest']
+  working_dir = manifest.job_dir
+  start = chunk['start']
+  end = chunk['start'] + chunk['duration']
+  regions = get_speech_regions(manifest.get('speech_timestamps') or [], start, end, args.speech_padding) if args.elide_silence else []
+
+  # A chunk without any speech found is sent whole, in case VAD missed some
+  if regions:
+    offset_map = OffsetMap.from_regions(regions, start)
+    speech_path = write_speech_audio(PcmAudio(video['audio_path']), regions, generate_temporary_path(working_dir, "pcm"))
+    try:
+      chunk['audio'] = extract_chunk(speech_path, 0, offset_map.duration, working_dir, args.upload_format, args.bitrate)
+    finally:
+      speech_path.unlink()
+    chunk['offset_map'] = offset_map.to_list()
+    metrics.count("elided_seconds", chunk['duration'] - offset_map.duration)
+    print(f"Chunk {chunk['index']}: keeping {offset_map.duration:.1f} of {chunk['duration']:.1f} seconds.")
+  else:
+    chunk['audio'] = extract_chunk(video['audio_path'], start, end, working_dir, args.upload_format, args.bitrate)
+    chunk['offset_map'] = None
+  manifest.update_chunk(chunk['index'], audio = str(chunk['audio'].relative_to(working_dir)), offset_map = chunk['offset_map'], status = "cut")
+
+
+
+def get_offset_map(chunk):
+  # Kept in the manifest as a list, for the chunks whose silences were elided
+  return OffsetMap(chunk['offset_map']) if chunk.get('offset_map') else None
+
+
+
+def get_audio_duration(chunk):
+  # Duration of the audio actually sent
+  offset_map = get_offset_map(chunk)
+  return offset_map.duration if offset_map is not None else chunk['duration']
+
+
+
+def get_job_dir(video_path: Path, args):
+  # Persistent work directory, kept when something fails so that the job can be resumed
+  # The given job directory holds one directory per video, owned by the job, never the directory itself
+  if args.job_dir:
+    return Path(args.job_dir) / get_default_job_dir(video_path).name
+  return get_default_job_dir(video_path)
+
+
+
+def prepare_video(video_path: Path, job_dir: Path, args):
+  # Local work only, runs in a worker process while the API works on the previous videos
+  manifest = JobManifest(job_dir, args.resume)
+  timings = {'extract': 0.0, 'vad': 0.0, 'split': 0.0}
+
+  # Extract all the audio in the video file
+  start_time = time.perf_counter()
+  audio_path = manifest.get_path('audio')
+  if audio_path is None:
+    print(f"Extracting audio of {video_path.name}...")
+    with metrics.span("extract", video = video_path.name):
+      audio_path = extract_all_audio(video_path, job_dir)
+    manifest.set_path('audio', audio_path)
+  audio = PcmAudio(audio_path)
+  timings['extract'] = time.perf_counter() - start_time
+
+  # Total audio duration
+  duration = audio.duration
+  print(f"Audio duration of {video_path.name}: {duration}")
+
+  # Find speech gaps
+  start_time = time.perf_counter()
+  speech_timestamps = manifest.get('speech_timestamps')
+  if speech_timestamps is None:
+    print(f"Finding speech gaps of {video_path.name}...")
+    with metrics.span("vad", video = video_path.name):
+      speech_timestamps = find_speech_timestamps(audio, streaming = not args.full_vad, workers = get_vad_workers(args.prepare_workers, args.vad_workers))
+    manifest.set('speech_timestamps', speech_timestamps)
+  timings['vad'] = time.perf_counter() - start_time
+
+  # Chunks of a previous run are only valid if they were cut the same way
+  chunk_settings = {
+    'split_mode'   : args.split_mode,
+    'max_duration' : args.max_duration,
+    'chunk_tokens' : args.chunk_tokens,
+    'concurrency'  : args.chunk_concurrency,
+    'segmenter'    : args.segmenter,
+    'elide_silence': args.elide_silence,
+    'padding'      : args.speech_padding,
+    'upload_format': args.upload_format,
+    'bitrate'      : args.bitrate
+  }
+  if manifest.get('chunk_settings') != chunk_settings:
+    manifest.reset('splits')
+    manifest.set('chunk_settings', chunk_settings)
+
+  # Find split points
+  start_time = time.perf_counter()
+  splits = manifest.get('splits')
+  if splits is None:
+    print("Finding optimal split points...")
+
+    # Chunks sized by the speech they hold, so that sparse videos take few requests and dense ones get replies that fit
+    speech_budget = None
+    if args.chunk_tokens > 0:
+      total_speech = sum(timestamp['end'] - timestamp['start'] for timestamp in speech_timestamps)
+      speech_budget = get_chunk_speech_budget(total_speech, args.chunk_tokens, args.chunk_concurrency)
+      print(f"{total_speech:.0f} seconds of speech, up to {speech_budget:.0f} per chunk (about {speech_budget * output_tokens_per_speech_second:.0f} output tokens).")
+    with metrics.span("split", video = video_path.name):
+      splits = find_optimal_split_points(speech_timestamps, duration, args.max_duration, args.split_mode, speech_budget)
+    splits.append(duration)
+    manifest.set('splits', splits)
+
+  # Chunks to process
+  chunks = manifest.get_chunks()
+  if not chunks:
+    if args.segmenter == "single" and not args.elide_silence:
+      # Cut every chunk with a single ffmpeg process
+      print("Splitting audio...")
+      with metrics.span("chunk", video = video_path.name):
+        cut_chunks = extract_chunks(audio_path, splits[:-1], job_dir, args.upload_format, args.bitrate)
+      for i, chunk in enumerate(cut_chunks):
+        chunks.append({
+          'index'   : i,
+          'start'   : chunk['start'],
+          'duration': chunk['end'] - chunk['start'],
+          'audio'   : str(chunk['audio'].relative_to(job_dir)),
+          'status'  : "cut"
+        })
+    else:
+      # Chunks are cut lazily by the first stage of the pipeline, their speech only when silences are elided
+      start = 0
+      for i, split in enumerate(splits):
+        chunks.append({
+          'index'   : i,
+          'start'   : start,
+          'duration': split - start,
+          'audio'   : None,
+          'status'  : "pending"
+        })
+        start = split
+    manifest.set_chunks(chunks)
+  else:
+    done = sum(1 for chunk in chunks if chunk['status'] == "translated")
+    print(f"{done}/{len(chunks)} chunks already done.")
+
+  # Audio of the chunks that must be cut again
+  for chunk in chunks:
+    if chunk.get('audio') is not None:
+      chunk['audio'] = job_dir / chunk['audio']
+      if not chunk['audio'].exists():
+        chunk['audio'] = None
+  timings['split'] = time.perf_counter() - start_time
+
+  # What was measured in this worker process goes back with the result
+  peak_rss = read_peak_rss()
+  if peak_rss is not None:
+    metrics.observe("prepare_max_rss_bytes", peak_rss)
+  return manifest, audio_path, chunks, timings, metrics.drain()
+
+
+
+def get_vad_workers(prepare_workers: int, vad_workers: int):
+  # Every preparation worker has its own pool of shard workers, each with its own copy of torch
+  # Their number is capped so that all the pools together share the cores instead of multiplying them
+  return max(1, min(vad_workers, os.cpu_count() // max(1, prepare_workers)))
+
+
+
+def create_prepare_executor(workers: int, vad_workers: int = 1):
+  # Worker processes for the extraction and VAD, each with its share of the cores and its VAD model loaded
+  # With several VAD workers, each also starts its pool of shard workers once for all the videos it prepares
+  workers = max(1, workers)
+  context = multiprocessing.get_context("spawn")
+  return ProcessPoolExecutor(max_workers = workers, mp_context = context, initializer = init_vad_process, initargs = (max(1, os.cpu_count() // workers), get_vad_workers(workers, vad_workers)))
+
+
+
+def prepare_videos(video_paths, args, executor: ProcessPoolExecutor = None):
+  # Extraction and VAD of the next videos run in a process pool, a few videos ahead of the consumer
+  # The pool is created for these videos, unless a resident one is given
+  workers = max(1, args.prepare_workers)
+  own_executor = executor is None
+  if own_executor:
+    executor = create_prepare_executor(workers, args.vad_workers)
+  submitted = deque()
+
+  def submit(index, video_path):
+    video = {
+      'index'     : index,
+      'video_path': video_path,
+      'submitted' : time.perf_counter(),
+      'status'    : "preparing"
+    }
+    video['future'] = executor.submit(prepare_video, video_path, get_job_dir(video_path, args), args)
+    submitted.append(video)
+
+  remaining = enumerate(video_paths)
+  for index, video_path in itertools.islice(remaining, workers + 1):
+    submit(index, video_path)
+
+  try:
+    while submitted:
+      video = submitted.popleft()
+      for index, video_path in itertools.islice(remaining, 1):
+        submit(index, video_path)
+
+      # A video that cannot be prepared is reported, the others go on
+      try:
+        video['manifest'], video['audio_path'], video['chunks'], video['timings'], snapshot = video.pop('future').result()
+        metrics.merge(snapshot)
+        video['status'] = "prepared"
+      except Exception as e:
+        logging.exception(f"Could not prepare {video['video_path'].name}. {get_fqn(e)}")
+        video['status'] = f"failed: {get_fqn(e)}"
+      yield video
+
+  # Do not start the videos nobody is waiting for anymore
+  finally:
+    if own_executor:
+      executor.shutdown(cancel_futures = True)
+    else:
+      for video in submitted:
+        video['future'].cancel()
+
+
+
+def write_subtitles(video_path: Path, results, targets = ("en",), subtitle_format: str = "srt"):
+  # Gather results in chunk order
+  transcriptions = []
+  translations = {target: [] for target in targets}
+  for chunk in sorted(results, key = lambda c: c['index']):
+    transcriptions.append({
+      'start': chunk['start'],
+      'data' : chunk['transcription']
+    })
+    for target in targets:
+      translations[target].append({
+        'start': chunk['start'],
+        'data' : chunk['translations'][target]
+      })
+
+  # Parse and merge transcriptions
+  transcribed_subtitles = merge_srt(transcriptions)
+
+  # Save transcribed subtitle
+  write_srt_file(video_path, "jp", transcribed_subtitles, subtitle_format)
+
+  # Parse, merge and save translations, one track per language
+  for target in targets:
+    translated_subtitles = merge_srt(translations[target])
+    write_srt_file(video_path, target, translated_subtitles, subtitle_format)
+
+
+
+def transcribe_in_batch(videos, client: genai.Client, args):
+  config, prompt = get_transcription_request()
+
+  # Chunks still to transcribe, by cache key so that identical audio is only sent once
+  pending = {}
+  for video in videos:
+    for chunk in video['chunks']:
+      if chunk.get('transcription') is not None:
+        continue
+      if chunk.get('audio') is None:
+        cut_chunk(video, chunk, args)
+      chunk['cache_key'] = get_transcription_cache_key(chunk['audio'])
+      cached = get_cached_result(chunk['cache_key'])
+      if cached is not None:
+        print(f"Using cached transcription for chunk {chunk['index']}.")
+        chunk['transcription'] = restore_subtitle_times(cached, get_offset_map(chunk))
+        video['manifest'].update_chunk(chunk['index'], transcription = chunk['transcription'], status = "transcribed")
+        continue
+      pending.setdefault(chunk['cache_key'], []).append((video, chunk))
+
+  # Jobs submitted by a previous run, if they hold some of these chunks
+  results = {}
+  batches = {}
+  for video in videos:
+    batch = video['manifest'].get('transcription_batch')
+    if batch is not None and any(key in pending for key in batch['keys']):
+      batches[batch['name']] = batch
+  for batch in batches.values():
+    print(f"Resuming batch job {batch['name']}.")
+    results.update(resume_batch(client, batch, "subtitles", args.batch_poll_interval))
+
+  # Audio of the chunks, uploaded once even when a request has to be sent again
+  # Nothing is inlined, the inlined requests of a batch job share a small size limit
+  uploads = UploadStore(client, 0)
+  handles = {}
+
+  def start_upload(key):
+    video, chunk = pending[key][0]
+    if key not in handles:
+      handles[key] = uploads.start(chunk['audio'], chunk.get('file_name'))
+      if 'file' in handles[key]:
+        video['manifest'].update_chunk(chunk['index'], file_name = handles[key]['file'].name, status = "uploaded")
+    return handles[key]
+
+  # Start every upload before waiting, the server processes the files side by side
+  new_keys = [key for key in pending if key not in results]
+  for key in new_keys:
+    start_upload(key)
+
+  # One job for the chunks of every video
+  requests = []
+  for key in new_keys:
+    content = types.Content(role = "user", parts = [types.Part.from_text(text = prompt), uploads.wait(start_upload(key))])
+    requests.append((key, make_batch_request(config, [content], key)))
+
+  # Every manifest remembers the job, to wait for it again instead of submitting it twice
+  def remember(batch):
+    for video in videos:
+      video['manifest'].set('transcription_batch', batch)
+
+  if requests:
+    results.update(run_batch(client, requests, "subtitles", f"geminisub-transcription-{int(time.time())}", args.batch_poll_interval, remember))
+
+  try:
+    for key, owners in pending.items():
+      video, chunk = owners[0]
+      subtitles = results.get(key)
+
+      # Failed or truncated requests are sent again one by one
+      if subtitles is None or isinstance(subtitles, TruncatedArray):
+        print(f"Batch transcription of chunk {chunk['index']} of {video['video_path'].name} is incomplete, transcribing it directly.")
+        subtitles = transcribe_file(client, uploads.wait(start_upload(key)), get_audio_duration(chunk), key)
+
+      # Add indices
+      else:
+        for i, subtitle in enumerate(subtitles):
+          subtitle['index'] = i + 1
+        put_cached_result(key, subtitles)
+
+      for video, chunk in owners:
+        chunk['transcription'] = restore_subtitle_times([dict(subtitle) for subtitle in subtitles], get_offset_map(chunk))
+        video['manifest'].update_chunk(chunk['index'], file_name = None, transcription = chunk['transcription'], status = "transcribed")
+
+  # Delete audio files from server
+  finally:
+    for handle in handles.values():
+      uploads.release(handle)
+
+
+
+def translate_in_batch(videos, client: genai.Client, args):
+  # Same batches of lines as the pipeline, packed video by video
+  items = []
+  for video in videos:
+    packer = LinePacker(args.translation_budget, args.context_lines, targets = args.targets)
+    for chunk in sorted(video['chunks'], key = lambda c: c['index']):
+      items.extend((video, item) for item in packer.add(chunk))
+    items.extend((video, item) for item in packer.flush())
+
+  # Batches still to translate, by cache key so that identical lines are only sent once
+  pending = {}
+  requests = []
+  for _, item in items:
+    if 'lines' not in item:
+      continue
+    lines = [{'id': i, 'text': text} for i, text in enumerate(item['texts'])]
+    key = get_translation_cache_key(lines, item['context_before'], item['context_after'], item['target'])
+    cached = get_cached_result(key)
+    if cached is not None:
+      item['translations'] = cached
+      continue
+    if key not in pending:
+      content = get_translation_content(lines, item['context_before'], item['context_after'], item['target'])
+      requests.append((key, make_batch_request(get_translation_config(target = item['target']), content, key)))
+    pending.setdefault(key, []).append(item)
+
+  if requests:
+    results = run_batch(client, requests, "lines", f"geminisub-translation-{int(time.time())}", args.batch_poll_interval)
+    for key, owners in pending.items():
+      item = owners[0]
+      lines = [{'id': i, 'text': text} for i, text in enumerate(item['texts'])]
+      matched = align_translations(lines, results.get(key) or [])
+
+      # Incomplete replies go through the line repair of the direct requests
+      if len(matched) == len(lines):
+        translated_texts = [matched[line['id']] for line in lines]
+        record_translation_stat('complete')
+        put_cached_result(key, translated_texts)
+      else:
+        print(f"Batch translation of {len(lines) - len(matched)} lines is incomplete, translating them directly.")
+        translated_texts = translate_lines(client, item['texts'], item['context_before'], item['context_after'], context_lines = args.context_lines, target = item['target'])
+
+      for owner in owners:
+        owner['translations'] = list(translated_texts)
+
+  # Put the translated lines back into their chunks
+  for video, item in items:
+    for chunk in assemble_translations(item):
+      if 'lines' in item or chunk.get('status') != "translated":
+        chunk['status'] = "translated"
+        video['manifest'].update_chunk(chunk['index'], translations = chunk['translations'], status = "translated")
+
+
+
+def process_videos_in_batch(videos, client: genai.Client, args):
+  # Local work first, for every video
+  videos = [video for video in videos if video['status'] == "prepared"]
+  for video in videos:
+    video['status'] = "processing"
+    video['queued'] = time.perf_counter()
+
+  # Then one batch job for all transcriptions, and one for all translations
+  with metrics.span("transcribe_batch"):
+    transcribe_in_batch(videos, client, args)
+  with metrics.span("translate_batch"):
+    translate_in_batch(videos, client, args)
+
+  for video in videos:
+    with metrics.span("write", video = video['video_path'].name):
+      write_subtitles(video['video_path'], video['chunks'], args.targets, args.subtitle_format)
+    if not args.keep_job:
+      video['manifest'].remove()
+    video['done'] = time.perf_counter()
+    video['status'] = "done"
+
+
+
+def print_summary(videos):
+  # Time spent on each file, the API time includes waiting behind the chunks of the previous files
+  print(f"{'File':40} {'Chunks':>6} {'Extract':>8} {'VAD':>8} {'Split':>8} {'API':>8} {'Total':>8}  Status")
+  for video in videos:
+    timings = video.get('timings', {})
+    api_time = video['done'] - video['queued'] if 'done' in video else None
+    total_time = video['done'] - video['submitted'] if 'done' in video else None
+    columns = [timings.get('extract'), timings.get('vad'), timings.get('split'), api_time, total_time]
+    columns = " ".join(f"{column:7.1f}s" if column is not None else f"{'-':>8}" for column in columns)
+    print(f"{video['video_path'].name[:40]:40} {len(video.get('chunks', [])):>6} {columns}  {video['status']}")
+
+
+
+def write_metrics(videos, args):
+  # Run report with the summary of every video, and the textfile scraped by the Prometheus node exporter
+  if args.metrics_report:
+    summary = [{
+      'video'   : str(video['video_path']),
+      'status'  : video['status'],
+      'chunks'  : len(video.get('chunks', [])),
+      'timings' : video.get('timings', {}),
+      'api_time': video['done'] - video['queued'] if 'done' in video else None,
+      'total'   : video['done'] - video['submitted'] if 'done' in video else None
+    } for video in videos]
+    metrics.write_report(Path(args.metrics_report), videos = summary, translation_stats = dict(translation_stats))
+    print(f"Metrics report written to {args.metrics_report}.")
+  if args.metrics_textfile:
+    metrics.write_prometheus(Path(args.metrics_textfile))
+
+
+
+def run(args, executor: ProcessPoolExecutor = None):
+  """Process the videos given on the command line, with the resident pool of preparation workers if any."""
+  # One client for the whole process, with a connection for each concurrent worker
+  client = get_client(os.environ.get("GEMINI_API_KEY"), args.pool_size or args.workers * (1 + len(args.targets)) + 4, args.base_url)
+
+  # Quota shared by all workers, back to the defaults unless this job overrides them
+  configure_rate_limits(args.rpm, args.tpm)
+
+  # Display models and exit if --list-models was given on the command line
+  if args.list_models:
+    display_available_models(client)
+    return
+
+  # Expand directories and globs into the list of videos
+  video_paths = expand_input_paths(args.input)
+
+  # Make sure the files exist
+  if not video_paths:
+    print(f"Error: No video file was found in {', '.join(args.input)}.")
+    return
+  print(f"Processing {len(video_paths)} files...")
+
+  # Results of previous runs
+  cache = None if args.no_cache else ResultCache(Path(args.cache_path), args.cache_size * 1024 * 1024)
+  set_result_cache(cache)
+
+  # A resident process runs one job after the other, each reports its own numbers
+  metrics.reset()
+  reset_translation_stats()
+
+  # Videos as they are prepared, for the summary
+  videos = []
+  def track(prepared_videos):
+    for video in prepared_videos:
+      videos.append(video)
+      yield video
+
+  try:
+    # All videos at once in batch mode, through a shared queue of chunks otherwise
+    prepared_videos = track(prepare_videos(video_paths, args, executor))
+    if args.batch:
+      process_videos_in_batch(list(prepared_videos), client, args)
+    else:
+      process_videos(prepared_videos, client, args)
+
+  except FFmpegError as err:
+    # This specifically catches our FFmpeg errors
+    print(f"An error occurred during processing: {err}")
+    print("Run again with --resume to continue from the last completed step.")
+
+  except Exception as e:
+    # This catches other issues (like file permissions or missing ffmpeg)
+    logging.exception(f"A general error occurred. {get_fqn(e)}")
+    print("Run again with --resume to continue from the last completed step.")
+
+  # The next job of a resident process opens the cache it is given
+  finally:
+    set_result_cache(None)
+    if cache is not None:
+      cache.close()
+
+  print_summary(videos)
+  write_metrics(videos, args)
+
+  # How the translation requests went
+  print(f"Translation requests: {translation_stats['complete']} complete, {translation_stats['repaired']} repaired "
+        f"({translation_stats['repaired_lines']} lines requested again), {translation_stats['full_retries']} full retries.")
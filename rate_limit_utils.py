@@ -0,0 +1,81 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import time
+import threading
+from collections import deque
+
+
+
+class RateLimiter:
+  """Sliding window limiter shared by all workers, tracking requests and tokens per minute for each model."""
+
+  def __init__(self, default_rpm: int, default_tpm: int, window: float = 60.0):
+    self.default_rpm = default_rpm
+    self.default_tpm = default_tpm
+    self.window = window
+    self.limits = {}
+    self.history = {}
+    self.blocked_until = {}
+    self.condition = threading.Condition()
+
+
+  def set_limits(self, model: str, rpm: int, tpm: int):
+    with self.condition:
+      self.limits[model] = (rpm, tpm)
+      self.condition.notify_all()
+
+
+  def acquire(self, model: str, tokens: int):
+    """Block until a request of the given size fits in the model quota. Returns a ticket for settle()."""
+    with self.condition:
+      while True:
+        now = time.monotonic()
+        wait_time = self._reserve_delay(model, tokens, now)
+        if wait_time <= 0:
+          ticket = [now, tokens]
+          self.history.setdefault(model, deque()).append(ticket)
+          return ticket
+        self.condition.wait(wait_time)
+
+
+  def settle(self, ticket, tokens: int):
+    """Replace the estimated token count of a request with the real one reported by the server."""
+    if tokens is None:
+      return
+    with self.condition:
+      ticket[1] = tokens
+      self.condition.notify_all()
+
+
+  def backoff(self, model: str, delay: float):
+    """Hold every request to the model for the given delay, as asked by the server."""
+    with self.condition:
+      until = time.monotonic() + delay
+      self.blocked_until[model] = max(self.blocked_until.get(model, 0), until)
+
+
+  def _reserve_delay(self, model: str, tokens: int, now: float):
+    # Honor the retry hint of the server first
+    blocked_until = self.blocked_until.get(model, 0)
+    if blocked_until > now:
+      return blocked_until - now
+
+    # Forget requests that left the window
+    rpm, tpm = self.limits.get(model, (self.default_rpm, self.default_tpm))
+    history = self.history.setdefault(model, deque())
+    while history and history[0][0] <= now - self.window:
+      history.popleft()
+
+    # Nothing in flight, let it through even if it is larger than the whole token quota
+    if not history:
+      return 0
+
+    # Find how long until enough requests and tokens expire
+    used_tokens = sum(ticket[1] for ticket in history)
+    if len(history) < rpm and used_tokens + tokens <= tpm:
+      return 0
+    freed_tokens = 0
+    for i, (timestamp, ticket_tokens) in enumerate(history):
+      freed_tokens += ticket_tokens
+      if len(history) - (i + 1) < rpm and used_tokens - freed_tokens + tokens <= tpm:
+        return timestamp + self.window - now
+    return history[-1][0] + self.window - now
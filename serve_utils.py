@@ -0,0 +1,164 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import io
+import os
+import sys
+import json
+import codecs
+import threading
+import contextlib
+import http.client
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+# Arguments holding paths, relative to the directory the job was submitted from
+path_arguments = ("job_dir", "cache_path", "metrics_report", "metrics_textfile")
+
+
+
+class StreamWriter(io.TextIOBase):
+  """Text stream sent to the submitter as HTTP chunks as soon as it is written, stdout of the job being run."""
+
+  def __init__(self, wfile):
+    self.wfile = wfile
+    self.lock = threading.Lock()
+    self.disconnected = False
+
+
+  def writable(self):
+    return True
+
+
+  def write(self, text):
+    # The job goes on when nobody listens anymore
+    data = text.encode("utf-8")
+    with self.lock:
+      if data and not self.disconnected:
+        try:
+          self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+          self.wfile.flush()
+        except OSError:
+          self.disconnected = True
+    return len(text)
+
+
+  def finish(self):
+    with self.lock:
+      if not self.disconnected:
+        try:
+          self.wfile.write(b"0\r\n\r\n")
+          self.wfile.flush()
+        except OSError:
+          self.disconnected = True
+
+
+
+def parse_address(address: str):
+  host, _, port = address.rpartition(":")
+  return host or "127.0.0.1", int(port)
+
+
+
+def serve(args, parse_args):
+  """Keep the client, the preparation workers and their VAD models warm, and run the jobs submitted over HTTP one after the other."""
+  # Heavy imports are only paid for once, by the resident process
+  from gemini_utils import get_client
+  from processing_utils import run, create_prepare_executor
+
+  print("Warming up...")
+  pool_size = args.pool_size or args.workers * (1 + len(args.targets)) + 4
+  get_client(os.environ.get("GEMINI_API_KEY"), pool_size, args.base_url)
+  workers = max(1, args.prepare_workers)
+  executor = create_prepare_executor(workers, args.vad_workers)
+  # One task per worker starts every process, each loads its VAD model and its shard workers
+  for future in [executor.submit(os.getpid) for _ in range(workers)]:
+    future.result()
+
+  # Jobs share the quota and the workers, running them side by side would only slow each one down
+  job_lock = threading.Lock()
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *log_args):
+      pass
+
+    def do_POST(self):
+      if self.path != "/jobs":
+        self.send_error(404)
+        return
+      request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+      # The output of the job is streamed back while it runs
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; charset=utf-8")
+      self.send_header("Transfer-Encoding", "chunked")
+      self.send_header("Connection", "close")
+      self.end_headers()
+      self.close_connection = True
+      writer = StreamWriter(self.wfile)
+
+      if job_lock.locked():
+        writer.write("Waiting for the previous jobs to finish...\n")
+      with job_lock, contextlib.redirect_stdout(writer), contextlib.redirect_stderr(writer):
+        try:
+          job_args = parse_args(request['argv'])
+          job_args.input = [os.path.join(request['cwd'], path) for path in job_args.input]
+          for name in path_arguments:
+            if getattr(job_args, name) is not None:
+              setattr(job_args, name, os.path.join(request['cwd'], getattr(job_args, name)))
+          # Every job runs with the resident client, a job meant for another server must not spend the quota of this one
+          if job_args.base_url is not None and job_args.base_url != args.base_url:
+            print(f"Error: This process sends its requests to {args.base_url or 'the Gemini API'}, not {job_args.base_url}. Start another one with --serve --base-url {job_args.base_url}, or run the job without --server.")
+          elif job_args.pool_size is not None and job_args.pool_size != pool_size:
+            print(f"Error: This process keeps {pool_size} connections open, not {job_args.pool_size}. Start another one with --serve --pool-size {job_args.pool_size}, or run the job without --server.")
+          else:
+            print(f"Job started by {self.client_address[0]}.", file = sys.__stdout__, flush = True)
+            run(job_args, executor)
+        except SystemExit:
+          # Invalid arguments, the usage was already written
+          pass
+        except Exception as e:
+          print(f"The job failed: {type(e).__name__}: {e}")
+      writer.finish()
+
+  host, port = parse_address(args.listen)
+  server = ThreadingHTTPServer((host, port), Handler)
+  server.daemon_threads = True
+  print(f"Ready, submit jobs with: python main.py --server http://{host}:{port} <video files...>")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    executor.shutdown(cancel_futures = True)
+
+
+
+def submit_job(server_url: str, argv):
+  """Send the command line to the resident process and print its output as it comes, without importing anything heavy."""
+  url = urlsplit(server_url)
+  connection = http.client.HTTPConnection(url.hostname, url.port or 80)
+  body = json.dumps({'argv': argv, 'cwd': os.getcwd()})
+  try:
+    connection.request("POST", "/jobs", body = body, headers = {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    if response.status != 200:
+      print(f"The server refused the job: {response.status} {response.reason}")
+      return False
+    # A character may be split between two reads
+    decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+    while True:
+      data = response.read1(65536)
+      if not data:
+        break
+      sys.stdout.write(decoder.decode(data))
+      sys.stdout.flush()
+    return True
+  except ConnectionError as e:
+    print(f"Could not reach the server at {server_url}: {e}")
+    return False
+  finally:
+    connection.close()
@@ -1,62 +1,189 @@
 # Written by Chiw the Neko <chiwtheneko@gmail.com>
+import os
+import threading
+import numpy as np
 from pathlib import Path
 from path_utils import generate_unique_path
-
-
-
-def shift_srt(start_time: float, start_index: int, subtitle_list):
-  for sub in subtitle_list:
-    sub['index'] = sub['index'] + start_index
-    sub['start'] = sub['start'] + start_time
-    sub['end'] = sub['end'] + start_time
+from subtitle_utils import SubtitleTrack, as_subtitle_track
 
 
 
 def merge_srt(chunks):
-  subtitles = []
+  # Chunks are shifted by their start time while being copied into the merged track
+  tracks = []
+  offsets = []
   i = 0
   for chunk in chunks:
     chunk_start_time = chunk['start']
-    chunk_subtitles = chunk['data']
+    chunk_subtitles = as_subtitle_track(chunk['data'])
     print("index:", i, "start:", chunk_start_time)
-    shift_srt(chunk_start_time, i, chunk_subtitles)
-    subtitles.extend(chunk_subtitles)
+    tracks.append(chunk_subtitles)
+    offsets.append(chunk_start_time)
     i += len(chunk_subtitles)
-  return subtitles
+  return SubtitleTrack.concatenate(tracks, offsets)
+
+
+
+def to_milliseconds(seconds):
+  # Round every time to the millisecond once, all formatting is done on integers
+  return np.rint(np.maximum(np.asarray(seconds, dtype = np.float64), 0) * 1000).astype(np.int64)
+
+
+
+def format_srt_timestamp(milliseconds: int):
+  hrs, milliseconds = divmod(milliseconds, 3600000)
+  mins, milliseconds = divmod(milliseconds, 60000)
+  secs, msecs = divmod(milliseconds, 1000)
+  return f"{hrs:02d}:{mins:02d}:{secs:02d},{msecs:03d}"
+
+
+
+def format_vtt_timestamp(milliseconds: int):
+  hrs, milliseconds = divmod(milliseconds, 3600000)
+  mins, milliseconds = divmod(milliseconds, 60000)
+  secs, msecs = divmod(milliseconds, 1000)
+  return f"{hrs:02d}:{mins:02d}:{secs:02d}.{msecs:03d}"
+
+
+
+def format_ass_timestamp(milliseconds: int):
+  # ASS only has centiseconds
+  centiseconds = (milliseconds + 5) // 10
+  hrs, centiseconds = divmod(centiseconds, 360000)
+  mins, centiseconds = divmod(centiseconds, 6000)
+  secs, csecs = divmod(centiseconds, 100)
+  return f"{hrs:d}:{mins:02d}:{secs:02d}.{csecs:02d}"
+
+
+
+def format_srt_cue(index: int, start: int, end: int, text: str):
+  return f"{index}\n{format_srt_timestamp(start)} --> {format_srt_timestamp(end)}\n{text}\n"
+
+
+
+def format_vtt_cue(index: int, start: int, end: int, text: str):
+  return f"{index}\n{format_vtt_timestamp(start)} --> {format_vtt_timestamp(end)}\n{text}\n"
+
+
+
+def format_ass_cue(index: int, start: int, end: int, text: str):
+  # Line breaks are written as \N, and braces would start override tags
+  text = text.replace("{", "(").replace("}", ")").replace("\r\n", "\n").replace("\n", "\\N")
+  return f"Dialogue: 0,{format_ass_timestamp(start)},{format_ass_timestamp(end)},Default,,0,0,0,,{text}\n"
+
+
+
+ass_header = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 1920
+PlayResY: 1080
+WrapStyle: 0
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,64,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,3,1,2,60,60,50,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+# Extension, header, cue formatter and separator of each output format
+subtitle_formats = {
+  "srt": {'extension': ".srt", 'header': "", 'format_cue': format_srt_cue, 'separator': "\n"},
+  "vtt": {'extension': ".vtt", 'header': "WEBVTT\n", 'format_cue': format_vtt_cue, 'separator': "\n"},
+  "ass": {'extension': ".ass", 'header': ass_header, 'format_cue': format_ass_cue, 'separator': ""},
+}
 
 
 
-def write_srt_file(video_path: Path, suffix: str, subtitle_list):
-  def format_timestamp(seconds_float):
-    # Calculate hours, minutes, seconds
-    hrs = int(seconds_float // 3600)
-    mins = int((seconds_float % 3600) // 60)
-    secs = int(seconds_float % 60)
+class SubtitleWriter:
+  """Appends the subtitles of each chunk to a partial file as soon as it is final, then renames it into place."""
 
-    # Calculate milliseconds (3 decimal places)
-    msecs = int(round((seconds_float - int(seconds_float)) * 1000))
+  def __init__(self, video_path: Path, suffix: str, subtitle_format: str = "srt"):
+    self.video_path = video_path
+    self.suffix = suffix
+    self.format = subtitle_formats[subtitle_format]
+    self.partial_path = video_path.with_name(f"{video_path.stem}.{suffix}.part{self.format['extension']}")
+    self.file = open(self.partial_path, "w", encoding = "utf-8")
+    self.file.write(self.format['header'])
+    self.nb_cues = 0
+    self.next_index = 0
+    self.waiting = {}
+    # Streamed subtitles of the next chunk written so far, replaced by its final subtitles
+    self.partial = None
+    self.lock = threading.Lock()
 
-    # Handle overflow from rounding (e.g., 59.9999 -> 60.000)
-    if msecs == 1000:
-      return format_timestamp(seconds_float + 0.001)
 
-    return f"{hrs:02d}:{mins:02d}:{secs:02d},{msecs:03d}"
+  def add(self, index: int, start_time: float, subtitles):
+    """Take the subtitles of chunk number index, written once every chunk before it is."""
+    with self.lock:
+      self.waiting[index] = (start_time, subtitles)
+      written = False
+      while self.next_index in self.waiting:
+        start_time, subtitles = self.waiting.pop(self.next_index)
+        if self.partial is not None and self.partial['index'] == self.next_index:
+          self.file.seek(self.partial['offset'])
+          self.file.truncate()
+          self.nb_cues = self.partial['nb_cues']
+          self.partial = None
+        self.next_index += 1
+        self.write(subtitles, start_time)
+        written = True
 
+      # Readable by a player at every step, and kept if the process dies
+      if written:
+        self._sync()
 
-  lines = []
-  for sub in subtitle_list:
-    start_str = format_timestamp(sub['start'])
-    end_str = format_timestamp(sub['end'])
 
-    # Format the block: Index, Timestamp, Text, followed by an empty line
-    block = f"{sub['index']}\n{start_str} --> {end_str}\n{sub['text']}\n"
-    lines.append(block)
+  def add_partial(self, index: int, start_time: float, subtitles):
+    """Take subtitles of chunk number index while its reply streams in, written right away if every chunk before it is."""
+    with self.lock:
+      if index != self.next_index:
+        return
+      if self.partial is None:
+        self.partial = {'index': index, 'offset': self.file.tell(), 'nb_cues': self.nb_cues, 'last_start': float("-inf")}
 
-  # Join blocks with an extra newline to ensure double-spacing between entries
-  content = "\n".join(lines)
+      # A continuation of a cut reply sends some subtitles again
+      subtitles = [subtitle for subtitle in subtitles if subtitle['start'] > self.partial['last_start']]
+      if subtitles:
+        self.partial['last_start'] = subtitles[-1]['start']
+        self.write(subtitles, start_time)
+        self._sync()
 
-  # Generate unique path for the file
-  output_path = generate_unique_path(video_path, suffix)
 
-  # Write to file
-  output_path.write_text(content, encoding = 'utf-8')
+  def write(self, subtitles, offset: float = 0):
+    """Append subtitles right away, shifted by offset."""
+    track = as_subtitle_track(subtitles)
+    starts = to_milliseconds(track.starts + offset).tolist()
+    ends = to_milliseconds(track.ends + offset).tolist()
+    cues = []
+    for start, end, text in zip(starts, ends, track.texts.tolist()):
+      self.nb_cues += 1
+      # SRT and WebVTT cues are separated by an empty line, so is the WebVTT header
+      if self.nb_cues > 1 or self.format['header']:
+        cues.append(self.format['separator'])
+      cues.append(self.format['format_cue'](self.nb_cues, start, end, text))
+    self.file.write("".join(cues))
+
+
+  def _sync(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+
+
+  def close(self):
+    """Finish the file and move it to its final name, returns that name."""
+    self._sync()
+    self.file.close()
+    output_path = generate_unique_path(self.video_path, self.suffix, self.format['extension'])
+    os.replace(self.partial_path, output_path)
+    return output_path
+
+
+
+def write_srt_file(video_path: Path, suffix: str, subtitles, subtitle_format: str = "srt"):
+  # Whole track at once, through the same path as the incremental writes
+  writer = SubtitleWriter(video_path, suffix, subtitle_format)
+  writer.write(subtitles)
+  return writer.close()
@@ -0,0 +1,101 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import numpy as np
+
+
+
+class SubtitleTrack:
+  """Subtitles as contiguous arrays of start and end times plus an array of texts, slicing gives views instead of copies."""
+
+  def __init__(self, starts, ends, texts):
+    self.starts = np.asarray(starts, dtype = np.float64)
+    self.ends = np.asarray(ends, dtype = np.float64)
+    self.texts = np.empty(len(texts), dtype = object)
+    self.texts[:] = texts
+
+
+  @classmethod
+  def from_subtitles(cls, subtitles):
+    # From the list of {'start', 'end', 'text'} dicts given by Gemini
+    return cls(
+      np.fromiter((subtitle['start'] for subtitle in subtitles), dtype = np.float64, count = len(subtitles)),
+      np.fromiter((subtitle['end'] for subtitle in subtitles), dtype = np.float64, count = len(subtitles)),
+      [subtitle['text'] for subtitle in subtitles]
+    )
+
+
+  @classmethod
+  def concatenate(cls, tracks, offsets = None):
+    # Copy every track into arrays allocated once, shifting each by its offset on the way
+    total = sum(len(track) for track in tracks)
+    starts = np.empty(total, dtype = np.float64)
+    ends = np.empty(total, dtype = np.float64)
+    texts = np.empty(total, dtype = object)
+    position = 0
+    for i, track in enumerate(tracks):
+      end = position + len(track)
+      offset = offsets[i] if offsets is not None else 0
+      np.add(track.starts, offset, out = starts[position:end])
+      np.add(track.ends, offset, out = ends[position:end])
+      texts[position:end] = track.texts
+      position = end
+    return cls._wrap(starts, ends, texts)
+
+
+  @classmethod
+  def _wrap(cls, starts, ends, texts):
+    # Build a track around existing arrays, without copying them
+    track = cls.__new__(cls)
+    track.starts = starts
+    track.ends = ends
+    track.texts = texts
+    return track
+
+
+  def __len__(self):
+    return len(self.starts)
+
+
+  def __getitem__(self, key):
+    # A slice is a view sharing the arrays of this track, an index gives a single subtitle
+    if isinstance(key, slice):
+      return self._wrap(self.starts[key], self.ends[key], self.texts[key])
+    return {
+      'start': float(self.starts[key]),
+      'end'  : float(self.ends[key]),
+      'text' : self.texts[key]
+    }
+
+
+  def between(self, start: float, end: float):
+    # View of the subtitles starting in [start, end), the track must be sorted by start time
+    first, last = np.searchsorted(self.starts, [start, end], side = "left")
+    return self[first:last]
+
+
+  def shifted(self, offset: float):
+    # The texts are shared, only the times are copied
+    return self._wrap(self.starts + offset, self.ends + offset, self.texts)
+
+
+  def with_texts(self, texts):
+    # Same times with other texts, e.g. a translation
+    if len(texts) != len(self):
+      raise ValueError(f"Expected {len(self)} texts, got {len(texts)}.")
+    track = self._wrap(self.starts, self.ends, np.empty(len(texts), dtype = object))
+    track.texts[:] = texts
+    return track
+
+
+  def to_subtitles(self, first_index: int = 1):
+    # Back to the list of dicts stored in the manifest and the cache
+    return [
+      {'index': first_index + i, 'start': start, 'end': end, 'text': text}
+      for i, (start, end, text) in enumerate(zip(self.starts.tolist(), self.ends.tolist(), self.texts.tolist()))
+    ]
+
+
+
+def as_subtitle_track(subtitles):
+  if isinstance(subtitles, SubtitleTrack):
+    return subtitles
+  return SubtitleTrack.from_subtitles(subtitles)
@@ -0,0 +1,107 @@
+# Written by Chiw the Neko <chiwtheneko@gmail.com>
+import time
+import threading
+from pathlib import Path
+from google import genai
+from google.genai import types, errors
+from gemini_utils import upload, wait_for_file
+from ffmpeg_utils import upload_mime_types
+from cache_utils import hash_file
+from metrics_utils import metrics
+
+
+
+class UploadStore:
+  """Audio sent to Gemini: inline when small, otherwise uploaded once per content hash and shared until its last user releases it."""
+
+  def __init__(self, client: genai.Client, inline_max_bytes: int = 4 * 1024 * 1024, poll_interval: float = 0.5, max_poll_interval: float = 10):
+    self.client = client
+    self.inline_max_bytes = inline_max_bytes
+    self.poll_interval = poll_interval
+    self.max_poll_interval = max_poll_interval
+    self.lock = threading.Lock()
+    self.files = {}
+    self.seconds_per_byte = None
+
+
+  def start(self, path: Path, file_name: str = None):
+    """Start sending the audio, returns a handle to wait on then release."""
+    # Small chunks go with the request itself, no upload round trip
+    size = path.stat().st_size
+    if size <= self.inline_max_bytes:
+      data = path.read_bytes()
+      metrics.count("inline_bytes", size)
+      return {'part': types.Part.from_bytes(data = data, mime_type = upload_mime_types[path.suffix.lstrip(".")])}
+
+    # The same audio is only uploaded once, whoever asks for it
+    file_hash = hash_file(path)
+    with self.lock:
+      entry = self.files.get(file_hash)
+      if entry is None:
+        entry = self.files[file_hash] = {
+          'file'    : None,
+          'size'    : size,
+          'users'   : 0,
+          'lock'    : threading.Lock()
+        }
+      entry['users'] += 1
+
+    with entry['lock']:
+      if entry['file'] is None:
+        entry['file'] = self._reuse(file_name) or upload(self.client, path, wait = False)
+        entry['uploaded'] = time.perf_counter()
+    return {'hash': file_hash, 'file': entry['file']}
+
+
+  def wait(self, handle):
+    """Wait until the server has processed the audio, returns the part to put in the request."""
+    if 'part' in handle:
+      return handle['part']
+
+    # A single thread polls each file, the others wait for its result
+    entry = self.files[handle['hash']]
+    with entry['lock']:
+      uploaded_file = entry['file']
+      if uploaded_file.state.name == "PROCESSING":
+        # Sleep as long as the previous files took to process before the first check
+        if self.seconds_per_byte is not None:
+          expected = self.seconds_per_byte * entry['size'] - (time.perf_counter() - entry['uploaded'])
+          time.sleep(min(max(0, expected), self.max_poll_interval))
+        uploaded_file = wait_for_file(self.client, self.client.files.get(name = uploaded_file.name), self.poll_interval, self.max_poll_interval)
+
+        # Learn how fast the server processes files
+        processing_time = time.perf_counter() - entry['uploaded']
+        metrics.observe("upload_wait_seconds", processing_time)
+        seconds_per_byte = processing_time / entry['size']
+        with self.lock:
+          self.seconds_per_byte = seconds_per_byte if self.seconds_per_byte is None else 0.7 * self.seconds_per_byte + 0.3 * seconds_per_byte
+        entry['file'] = uploaded_file
+
+    handle['file'] = uploaded_file
+    return types.Part.from_uri(file_uri = uploaded_file.uri, mime_type = uploaded_file.mime_type)
+
+
+  def release(self, handle):
+    """Delete the uploaded file once nobody needs it anymore."""
+    if 'hash' not in handle:
+      return
+    with self.lock:
+      entry = self.files[handle['hash']]
+      entry['users'] -= 1
+      if entry['users'] > 0:
+        return
+      del self.files[handle['hash']]
+    self.client.files.delete(name = entry['file'].name)
+
+
+  def _reuse(self, file_name: str):
+    # File uploaded before the job was interrupted, if the server still has it
+    if file_name is None:
+      return None
+    try:
+      uploaded_file = self.client.files.get(name = file_name)
+      if uploaded_file.state.name in ("ACTIVE", "PROCESSING"):
+        return uploaded_file
+    except errors.APIError:
+      pass
+    return None
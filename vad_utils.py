@@ -1,6 +1,13 @@
 # # Written by Chiw the Neko <chiwtheneko@gmail.com>
+import torch
+import bisect
+import numpy as np
+import multiprocessing
+import multiprocessing.util
 from pathlib import Path
-from silero_vad import load_silero_vad, read_audio, get_speech_timestamps
+from concurrent.futures import ProcessPoolExecutor
+from silero_vad import load_silero_vad, get_speech_timestamps
+from audio_utils import PcmAudio
 
 
 
@@ -18,22 +25,302 @@ def get_vad_model():
 
 
 
-def find_speech_timestamps(audio_path: Path):
+class SpeechSegmenter:
+  """Incremental version of silero's get_speech_timestamps_from_probs, fed one speech probability at a time."""
+
+  def __init__(self, sample_rate: int, threshold: float = 0.5, min_speech_duration_ms: int = 250, min_silence_duration_ms: int = 100, speech_pad_ms: int = 30):
+    self.sample_rate = sample_rate
+    self.window_size = 512 if sample_rate == 16000 else 256
+    self.threshold = threshold
+    self.neg_threshold = max(threshold - 0.15, 0.01)
+    self.min_speech_samples = sample_rate * min_speech_duration_ms / 1000
+    self.min_silence_samples = sample_rate * min_silence_duration_ms / 1000
+    self.speech_pad_samples = sample_rate * speech_pad_ms / 1000
+    self.nb_probs = 0
+    self.triggered = False
+    self.speech_start = 0
+    self.temp_end = 0
+    self.pending = None
+
+
+  def push(self, speech_prob: float):
+    """Feed the probability of the next window, returns the segments finished so far, in samples."""
+    cur_sample = self.window_size * self.nb_probs
+    self.nb_probs += 1
+
+    # Speech came back before the silence was long enough
+    if speech_prob >= self.threshold and self.temp_end:
+      self.temp_end = 0
+
+    # Start of speech
+    if speech_prob >= self.threshold and not self.triggered:
+      self.triggered = True
+      self.speech_start = cur_sample
+      return []
+
+    # Silence while in speech
+    if speech_prob < self.neg_threshold and self.triggered:
+      if not self.temp_end:
+        self.temp_end = cur_sample
+      if cur_sample - self.temp_end < self.min_silence_samples:
+        return []
+      start, end = self.speech_start, self.temp_end
+      self.triggered = False
+      self.temp_end = 0
+      if end - start > self.min_speech_samples:
+        return self._add(start, end)
+
+    return []
+
+
+  def finish(self, nb_samples: int):
+    """Close the stream, returns the remaining segments."""
+    segments = []
+    if self.triggered and nb_samples - self.speech_start > self.min_speech_samples:
+      segments = self._add(self.speech_start, nb_samples)
+    self.triggered = False
+
+    # The last segment is padded at its end only
+    if self.pending is not None:
+      start, end = self.pending
+      segments.append((start, int(min(nb_samples, end + self.speech_pad_samples))))
+      self.pending = None
+    return segments
+
+
+  def _add(self, start: int, end: int):
+    # The first segment is padded at its start
+    if self.pending is None:
+      self.pending = (int(max(0, start - self.speech_pad_samples)), end)
+      return []
+
+    # Split the padding with the previous segment, now that the silence between them is known
+    previous_start, previous_end = self.pending
+    silence_duration = start - previous_end
+    if silence_duration < 2 * self.speech_pad_samples:
+      previous_end += int(silence_duration // 2)
+      start = int(max(0, start - silence_duration // 2))
+    else:
+      previous_end = int(previous_end + self.speech_pad_samples)
+      start = int(max(0, start - self.speech_pad_samples))
+    self.pending = (start, end)
+    return [(previous_start, previous_end)]
+
+
+
+def stream_speech_timestamps(audio: PcmAudio, block_duration: float = 30.0, start_sample: int = 0, end_sample: int = None):
+  """Yield speech timestamps in seconds while reading the audio block by block, memory stays constant."""
+  model = get_vad_model()
+  model.reset_states()
+  segmenter = SpeechSegmenter(audio.sample_rate)
+  window_size = segmenter.window_size
+  block_size = int(block_duration * audio.sample_rate) // window_size * window_size
+  if end_sample is None or end_sample > audio.nb_samples:
+    end_sample = audio.nb_samples
+
+  def to_seconds(segment):
+    start, end = segment
+    return {
+      'start': max(round((start_sample + start) / audio.sample_rate, 1), 0),
+      'end'  : min(round((start_sample + end) / audio.sample_rate, 1), audio.duration)
+    }
+
+  with torch.no_grad():
+    for block_start in range(start_sample, end_sample, block_size):
+      block = torch.from_numpy(audio.read(block_start, min(block_start + block_size, end_sample)))
+      for window_start in range(0, len(block), window_size):
+        window = block[window_start: window_start + window_size]
+        if len(window) < window_size:
+          window = torch.nn.functional.pad(window, (0, window_size - len(window)))
+        for segment in segmenter.push(model(window, audio.sample_rate).item()):
+          yield to_seconds(segment)
+
+  for segment in segmenter.finish(end_sample - start_sample):
+    yield to_seconds(segment)
+
+
+
+def set_vad_threads(threads: int):
+  # Share the cores between the processes running VAD side by side
+  torch.set_num_threads(max(1, threads))
+
+
+
+def init_vad_process(threads: int, shard_workers: int = 1):
+  # Worker process of a pool, ready to run VAD as soon as its first task comes
+  set_vad_threads(threads)
+  get_vad_model()
+
+  # Its shard workers too, when the audio is spread over several processes
+  if shard_workers > 1:
+    get_shard_executor(shard_workers)
+
+
+
+def _init_vad_worker():
+  # Each worker runs its own model on a single core
+  set_vad_threads(1)
+  get_vad_model()
+
+
+
+# Pool of shard workers, started once per process and kept with their models loaded
+_shard_executor = None
+_shard_workers = 0
+
+
+
+def get_shard_executor(workers: int):
+  """Pool running VAD over shards, reused by every video processed in this process."""
+  global _shard_executor, _shard_workers
+  if _shard_executor is None or _shard_workers != workers:
+    if _shard_executor is not None:
+      _shard_executor.shutdown()
+    context = multiprocessing.get_context("spawn")
+    if _shard_executor is None:
+      # A pool worker joins its children when it exits, the shard workers are stopped before that and before its queues are closed
+      multiprocessing.util.Finalize(None, _shutdown_shard_executor, exitpriority = 20)
+    _shard_executor = ProcessPoolExecutor(max_workers = workers, mp_context = context, initializer = _init_vad_worker)
+    _shard_workers = workers
+    # One task per worker starts every process, each loads its model
+    for future in [_shard_executor.submit(set_vad_threads, 1) for _ in range(workers)]:
+      future.result()
+  return _shard_executor
+
+
+
+def _shutdown_shard_executor():
+  global _shard_executor, _shard_workers
+  if _shard_executor is not None:
+    _shard_executor.shutdown()
+    _shard_executor = None
+    _shard_workers = 0
+
+
+
+def _find_shard_speech_timestamps(audio_path: Path, start_sample: int, end_sample: int, core_start: float, core_end: float):
+  # Keep the segments touching the part of the shard this worker is responsible for
+  audio = PcmAudio(audio_path)
+  segments = []
+  for segment in stream_speech_timestamps(audio, start_sample = start_sample, end_sample = end_sample):
+    if segment['end'] > core_start and segment['start'] < core_end:
+      segments.append(segment)
+  return segments
+
+
+
+def find_speech_timestamps_parallel(audio: PcmAudio, workers: int, shard_duration: float = None, overlap: float = 15.0, executor: ProcessPoolExecutor = None):
+  """Run VAD over overlapping shards in a process pool, then stitch the segments back together."""
+  # One shard per worker by default, so that every worker is busy however long the audio is
+  # Shards stay a few times longer than the overlap, or most of the work would be done twice
+  overlap_size = int(overlap * audio.sample_rate) // 512 * 512
+  if shard_duration is None:
+    shard_size = max(-(-audio.nb_samples // workers), 4 * overlap_size)
+  else:
+    shard_size = int(shard_duration * audio.sample_rate)
+  # Shards are cut on window boundaries, the overlap gives the model some context around each shard
+  shard_size = max(512, -(-shard_size // 512) * 512)
+  shards = []
+  for core_start in range(0, audio.nb_samples, shard_size):
+    core_end = min(core_start + shard_size, audio.nb_samples)
+    shards.append((
+      audio.path,
+      max(0, core_start - overlap_size),
+      min(audio.nb_samples, core_end + overlap_size),
+      core_start / audio.sample_rate,
+      core_end / audio.sample_rate
+    ))
+
+  # One model per worker process, in the pool of this process unless one is given
+  if executor is None:
+    executor = get_shard_executor(workers)
+  results = list(executor.map(_find_shard_speech_timestamps, *zip(*shards)))
+
+  # Merge the segments seen by two shards, or crossing a shard boundary
+  speech_timestamps = []
+  for segment in sorted((s for segments in results for s in segments), key = lambda s: s['start']):
+    if speech_timestamps and segment['start'] <= speech_timestamps[-1]['end']:
+      speech_timestamps[-1]['end'] = max(speech_timestamps[-1]['end'], segment['end'])
+    else:
+      speech_timestamps.append(segment)
+  return speech_timestamps
+
+
+
+def find_speech_timestamps(audio: PcmAudio, streaming: bool = True, workers: int = 1):
+  # Spread the audio over several processes
+  if workers > 1 and audio.nb_samples > 0:
+    return find_speech_timestamps_parallel(audio, workers)
+
+  # Read the audio window by window instead of loading it whole
+  if streaming:
+    return list(stream_speech_timestamps(audio))
+
   model = get_vad_model()
-  wav = read_audio(str(audio_path))
+  wav = torch.from_numpy(audio.read())
   speech_timestamps = get_speech_timestamps(
     wav,
     model,
+    sampling_rate = audio.sample_rate,
     return_seconds = True,  # Return speech timestamps in seconds (default is samples)
   )
   return speech_timestamps
 
 
 
-def find_optimal_split_points(speech_timestamps, total_duration, max_duration):
-  splits = []
+# Transcription JSON per second of speech, the text plus the times and keys of a cue every few seconds
+output_tokens_per_speech_second = 15
+
+
+
+class SpeechDensity:
+  """Seconds of speech before any point in time according to VAD, to size the chunks by what they hold rather than by their length."""
+
+  def __init__(self, speech_timestamps):
+    self.starts = np.array([timestamp['start'] for timestamp in speech_timestamps], dtype = np.float64)
+    self.ends = np.array([timestamp['end'] for timestamp in speech_timestamps], dtype = np.float64)
+    self.cumulative = np.concatenate(([0.0], np.cumsum(self.ends - self.starts)))
+
+
+  @property
+  def total(self):
+    return float(self.cumulative[-1])
+
+
+  def before(self, t):
+    """Seconds of speech before t, t can be an array."""
+    t = np.asarray(t, dtype = np.float64)
+    if len(self.starts) == 0:
+      return np.zeros_like(t)
+    # Whole segments starting before t, plus the part of the last one that is before t
+    last = np.searchsorted(self.starts, t, side = "right") - 1
+    clamped = np.maximum(last, 0)
+    partial = np.clip(t - self.starts[clamped], 0, self.ends[clamped] - self.starts[clamped])
+    return np.where(last >= 0, self.cumulative[clamped] + partial, 0.0)
+
 
-  # Identify all gaps between speech
+  def time_at(self, speech_seconds: float):
+    """Earliest time with the given seconds of speech before it, infinite past the last segment."""
+    if speech_seconds <= 0 or len(self.starts) == 0:
+      return 0.0 if speech_seconds <= 0 else float("inf")
+    segment = int(np.searchsorted(self.cumulative, speech_seconds, side = "left")) - 1
+    if segment >= len(self.starts):
+      return float("inf")
+    return float(self.starts[segment] + speech_seconds - self.cumulative[segment])
+
+
+
+def get_chunk_speech_budget(total_speech: float, token_budget: int, concurrency: int = 1, min_speech: float = 20.0):
+  """Seconds of speech a chunk may hold so that its transcription fits the token budget, and the video gives work to every worker."""
+  budget = token_budget / output_tokens_per_speech_second
+  if concurrency > 1 and total_speech > 0:
+    budget = min(budget, max(total_speech / concurrency, min_speech))
+  return budget
+
+
+
+def find_speech_gaps(speech_timestamps):
+  # Identify all gaps between speech, sorted since the speech segments are
   gaps = []
   for i in range(len(speech_timestamps) - 1):
     gap_start = speech_timestamps[i]['end']
@@ -44,23 +331,106 @@ def find_optimal_split_points(speech_timestamps, total_duration, max_duration):
       'duration': gap_end - gap_start,
       'midpoint': (gap_start + gap_end) / 2
     })
+  return gaps
+
+
+
+def find_balanced_split_points(gaps, total_duration, max_duration, gap_weight: float = 0.02, gap_cap: float = 5.0, density: SpeechDensity = None, speech_budget: float = None):
+  """Dynamic programming over the gap midpoints: fewest chunks first, then balanced lengths and long gaps."""
+  # Furthest end of a chunk starting at t, by length and by the speech it holds
+  def limit(t):
+    if speech_budget is None:
+      return t + max_duration
+    return min(t + max_duration, density.time_at(float(density.before(t)) + speech_budget))
+
+  # Candidate split points, with forced points wherever there is no gap before the limit
+  positions = [0.0]
+  bonuses = [0.0]
+  for gap in gaps:
+    if not 0 < gap['midpoint'] < total_duration or gap['midpoint'] <= positions[-1]:
+      continue
+    while gap['midpoint'] > limit(positions[-1]):
+      positions.append(limit(positions[-1]))
+      bonuses.append(0.0)
+    positions.append(gap['midpoint'])
+    bonuses.append(gap_weight * min(gap['duration'], gap_cap) / gap_cap)
+  while total_duration > limit(positions[-1]):
+    positions.append(limit(positions[-1]))
+    bonuses.append(0.0)
+  positions.append(total_duration)
+  bonuses.append(0.0)
+  positions = np.array(positions)
+  bonuses = np.array(bonuses)
+
+  # A chunk can start at the first position within both limits
+  first_reachable = np.searchsorted(positions, positions - max_duration - 1e-6, side = "left")
+  if speech_budget is not None:
+    speech = density.before(positions)
+    first_reachable = np.maximum(first_reachable, np.searchsorted(speech, speech - speech_budget - 1e-6, side = "left"))
+
+  # Every chunk costs 2, more than balancing and gap bonuses can ever save, so the number of chunks stays minimal
+  # The squared length rewards balanced chunks, the bonus rewards cutting in long gaps
+  # The length is the share of the tightest limit, the duration or the speech
+  cost = np.full(len(positions), np.inf)
+  previous = np.zeros(len(positions), dtype = np.int64)
+  cost[0] = 0
+  for j in range(1, len(positions)):
+    lo = first_reachable[j]
+    lengths = (positions[j] - positions[lo:j]) / max_duration
+    if speech_budget is not None:
+      lengths = np.maximum(lengths, (speech[j] - speech[lo:j]) / speech_budget)
+    candidates = cost[lo:j] + 2 + lengths * lengths
+    best = int(np.argmin(candidates))
+    cost[j] = candidates[best] - bonuses[j]
+    previous[j] = lo + best
+
+  # Walk back from the end
+  splits = []
+  j = previous[len(positions) - 1]
+  while j > 0:
+    splits.append(float(positions[j]))
+    j = previous[j]
+  splits.reverse()
+  return splits
+
+
+
+def find_optimal_split_points(speech_timestamps, total_duration, max_duration, mode: str = "greedy", speech_budget: float = None):
+  # Chunks are at most max_duration long, and hold at most speech_budget seconds of speech when it is given
+  gaps = find_speech_gaps(speech_timestamps)
+  density = SpeechDensity(speech_timestamps) if speech_budget is not None else None
+
+  # Globally optimal splits
+  if mode == "balanced":
+    return find_balanced_split_points(gaps, total_duration, max_duration, density = density, speech_budget = speech_budget)
+
+  # Index the gaps by midpoint so that each window is a binary search
+  midpoints = [g['midpoint'] for g in gaps]
 
   # Find split points
+  splits = []
   current_search_start = 0
   video_end = total_duration
 
-  while (current_search_start + max_duration) < video_end:
+  while True:
+    # Sparse stretches make long windows, dense ones short windows
     window_end = current_search_start + max_duration
+    if speech_budget is not None:
+      window_end = min(window_end, density.time_at(float(density.before(current_search_start)) + speech_budget))
+    if window_end >= video_end:
+      break
 
-    # Filter gaps that fall within this 10-minute segment
-    valid_gaps = [g for g in gaps if current_search_start < g['midpoint'] <= window_end]
+    # Gaps that fall within this window
+    first_gap = bisect.bisect_right(midpoints, current_search_start)
+    last_gap = bisect.bisect_right(midpoints, window_end)
 
-    if not valid_gaps:
+    if first_gap == last_gap:
       # Fallback if no speech gap is found (unlikely for a large enough max_duration)
       splits.append(window_end)
       current_search_start = window_end
     else:
       # Pick the longest gap among the three last
+      valid_gaps = gaps[max(first_gap, last_gap - 3):last_gap]
       best_gap = valid_gaps[-1]
       if len(valid_gaps) > 1 and valid_gaps[-2]['duration'] > best_gap['duration']:
         best_gap = valid_gaps[-2]